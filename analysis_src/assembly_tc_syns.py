@@ -61,8 +61,9 @@ def get_tc2assembly_syn_properties(config, sim, assembly):
 def main(config_path, seed, assembly_id):
     config = Config(config_path)
     sim = utils.get_bluepy_simulation(utils.get_sim_path(config.root_path).loc[seed])
-    assembly_grp_dict, _ = utils.load_assemblies_from_h5(config.h5f_name, config.h5_prefix_assemblies)
-    assembly = assembly_grp_dict["seed%i" % seed].loc((assembly_id, seed))
+    _, assembly_grp = next(utils.iter_assemblies_from_h5(config.h5f_name, config.h5_prefix_assemblies,
+                                                         seeds=["seed%i" % seed]))
+    assembly = assembly_grp.loc((assembly_id, seed))
 
     df = get_tc2assembly_syn_properties(config, sim, assembly)
     df.to_pickle("assembly%i_tc_syn_properties_seed%i.pkl" % (assembly_id, seed))
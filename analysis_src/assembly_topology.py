@@ -8,7 +8,8 @@ import h5py
 from tqdm import tqdm
 import numpy as np
 import pandas as pd
-from conntility.circuit_models import circuit_connection_matrix
+from scipy.sparse import csr_matrix, coo_matrix
+from joblib import Parallel, delayed
 
 from assemblyfire.config import Config
 import assemblyfire.utils as utils
@@ -20,6 +21,32 @@ DSET_CLST = "strength"
 DSET_PVALUE = "pvalue"
 
 
+def _assembly_prob_mi(gids, assembly_grp, innervation, seed, n_bins, bin_min_n, sign_th, rng=None):
+    """Bins gids based on `innervation` and gets assembly probabilities and (relative) fraction of entropy explained"""
+    bin_centers, bin_idx = topology.bin_gids_by_innervation(innervation, gids, n_bins)
+    plot_args = topology.assembly_membership_probability(gids, assembly_grp, bin_centers, bin_idx, bin_min_n)
+    mi = topology.assembly_rel_frac_entropy_explained(gids, assembly_grp, bin_centers, bin_idx,
+                                                      seed, bin_min_n, sign_th, rng=rng)
+    return plot_args, mi
+
+
+def _assembly_prob_mi_across_seeds(assembly_grp_dict, innervations, n_bins, bin_min_n, sign_th):
+    """Runs `_assembly_prob_mi()` for all seeds in parallel. `innervations` is a dict with seeds as keys
+    and (gids, innervation) tuples as values. (Only the calculations are parallelized, as plotting isn't thread safe)
+    Each seed gets its own random generator (seeded from the global `np.random` state, in the order of the seeds),
+    so that the shuffled controls don't depend on the order in which the threads draw random numbers"""
+    seeds = list(innervations.keys())
+    if not len(seeds):
+        return {}
+    rngs = [np.random.default_rng(rng_seed) for rng_seed in np.random.randint(np.iinfo(np.int32).max, size=len(seeds))]
+    nprocs = max(1, min(len(seeds), os.cpu_count() - 1))
+    with Parallel(n_jobs=nprocs, prefer="threads") as p:
+        results = p(delayed(_assembly_prob_mi)(innervations[seed][0], assembly_grp_dict[seed], innervations[seed][1],
+                                               seed, n_bins, bin_min_n, sign_th, rng)
+                    for seed, rng in zip(seeds, rngs))
+    return dict(zip(seeds, results))
+
+
 def get_spiking_proj_gids(config, sim_config, circuit_config):
     """Loads grouped (to patterns + non-specific) TC gids (that spike at least once)"""
     proj_edge_pops = utils.get_proj_edge_pops(circuit_config, config.edge_pop)
@@ -42,6 +69,7 @@ def get_spiking_proj_gids(config, sim_config, circuit_config):
 
 def get_proj_innervation(config):
     """Looks up how many projection fibers, and pattern fibers innervate the neurons"""
+    from conntility.circuit_models import circuit_connection_matrix
     sim = utils.get_bluepy_simulation(utils.get_sim_path(config.root_path).iloc[0])
     c = sim.circuit
     proj_gids, pattern_gids = get_spiking_proj_gids(config, sim.config, c.config)
@@ -52,12 +80,19 @@ def get_proj_innervation(config):
         # get (sparse) connectivity matrix between the input fibers and neurons in the circuit
         input_conn_mat = circuit_connection_matrix(c, edge_pop, pre_gids, post_gids, load_full=True).tocsr()
         conn_matrices[edge_pop] = input_conn_mat
-        proj_indegrees[edge_pop] = np.array(input_conn_mat.sum(axis=0)).flatten()
         if edge_pop == list(config.patterns_edges.values())[0]:
-            # for each pattern get how many pattern fibers innervate the neurons
-            for pattern_name, gids in pattern_gids.items():
-                pattern_idx = np.in1d(pre_gids, gids, assume_unique=True)
-                pattern_indegrees[pattern_name] = np.array(input_conn_mat[pattern_idx].sum(axis=0)).flatten()
+            # for each pattern get how many pattern fibers innervate the neurons: build an indicator matrix
+            # (first row: all fibers, and then one row per pattern) and get all indegrees with a single product
+            pattern_names = list(pattern_gids.keys())
+            indicator = np.vstack([np.ones(len(pre_gids), dtype=bool)] +
+                                  [np.in1d(pre_gids, pattern_gids[pattern_name], assume_unique=True)
+                                   for pattern_name in pattern_names])
+            indegrees = (csr_matrix(indicator, dtype=int) @ input_conn_mat).toarray()
+            proj_indegrees[edge_pop] = indegrees[0]
+            for i, pattern_name in enumerate(pattern_names):
+                pattern_indegrees[pattern_name] = indegrees[i + 1]
+        else:  # the matrix is binary (no `edge_property` passed), so the number of nonzeros is the same as the sum
+            proj_indegrees[edge_pop] = input_conn_mat.getnnz(axis=0)
     return conn_matrices, proj_indegrees, pattern_indegrees, post_gids
 
 
@@ -67,7 +102,7 @@ def n_assemblies_from_projs(assembly_grp_dict, proj_indegrees, gids, fig_path, n
         n_assemblies = np.sum(assembly_grp.as_bool(), axis=1)
         # as assembly groups only store info about spiking gids,
         # we'll need to get rid of the non-spiking ones from the degree vectors...
-        spiking_gid_idx = np.in1d(gids, assembly_grp.all, assume_unique=True)
+        spiking_gid_idx = utils.isin_sorted(gids, assembly_grp.all)
         proj_indegrees_seed = {proj_name: indegrees[spiking_gid_idx] for proj_name, indegrees in proj_indegrees.items()}
         bin_centers_dict, assembly_probs, assembly_probs_low, assembly_probs_high = {}, {}, {}, {}
         for proj_name, indegrees in proj_indegrees_seed.items():
@@ -77,10 +112,8 @@ def n_assemblies_from_projs(assembly_grp_dict, proj_indegrees, gids, fig_path, n
             bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
             bin_centers_dict[proj_name] = bin_centers
             bin_idx = np.digitize(indegrees, bin_edges, right=True)
-            probs = np.zeros_like(bin_centers, dtype=np.float32)
-            probs_low, probs_high = np.zeros_like(probs), np.zeros_like(probs)
-            for i in range(len(bin_centers)):
-                probs[i], probs_low[i], probs_high[i] = topology.prob_with_binom_ci(n_assemblies[bin_idx == i + 1], bin_min_n)
+            probs, probs_low, probs_high = topology.binned_prob_with_binom_ci(n_assemblies, bin_idx,
+                                                                              len(bin_centers), bin_min_n)
             assembly_probs[proj_name] = probs
             assembly_probs_low[proj_name], assembly_probs_high[proj_name] = probs_low, probs_high
         fig_name = os.path.join(fig_path, "assembly_n_from_projections_seed%s.png" % seed)
@@ -93,29 +126,33 @@ def assembly_prob_mi_from_proj_ci(assembly_grp_dict, conn_matrices, gids, fig_pa
     """Plots assembly probabilities and (relative) fraction of entropy explained
     from common innervation with projections"""
     proj_names = list(conn_matrices.keys())
+    # common innervation is computed on demand (only for the columns of the assembly) from these,
+    # instead of building the full (N_post x N_post) `matrix.T * matrix` (which can have billions of nonzeros)
+    conn_matrices_t = {proj_name: matrix.transpose().tocsr() for proj_name, matrix in conn_matrices.items()}
+    conn_matrices_csc = {proj_name: matrix.tocsc() for proj_name, matrix in conn_matrices.items()}
     for seed, assembly_grp in assembly_grp_dict.items():
         plot_args = [{proj_name: {} for proj_name in proj_names}, {proj_name: {} for proj_name in proj_names},
                      {proj_name: {} for proj_name in proj_names}, {proj_name: {} for proj_name in proj_names}]
-        for proj_name, matrix in conn_matrices.items():
-            ci_matrix = matrix.transpose() * matrix
-            ci_matrix[range(len(gids)), range(len(gids))] = 0
+        for proj_name in proj_names:
             proj_cis = {}
             for assembly in assembly_grp.assemblies:
-                idx = np.in1d(gids, assembly.gids, assume_unique=True)
-                sub_matrix = ci_matrix[:, idx]
+                idx = utils.isin_sorted(gids, assembly.gids)
+                sub_matrix = conn_matrices_t[proj_name] @ conn_matrices_csc[proj_name][:, idx]
                 ci = np.array(sub_matrix.sum(axis=1)).flatten().astype(np.float32)
+                # remove the diagonal of `matrix.T * matrix` (i.e. common innervation with itself)
+                ci[idx] -= np.array(sub_matrix[np.nonzero(idx)[0], np.arange(np.sum(idx))]).flatten()
                 ci[idx] /= (np.sum(idx) - 1)
                 ci[~idx] /= np.sum(idx)
                 proj_cis[assembly.idx[0]] = ci
 
-            binned_gids, bin_centers, bin_idx = topology.bin_gids_by_innervation(proj_cis, gids, n_bins)
+            bin_centers, bin_idx = topology.bin_gids_by_innervation(proj_cis, gids, n_bins)
             # getting MI matrices for all projections:
             mi = topology.assembly_rel_frac_entropy_explained(gids, assembly_grp, bin_centers, bin_idx,
                                                               seed, bin_min_n, sign_th)
             fig_name = os.path.join(fig_path, "frac_entropy_explained_by_%s_CI_%s.png" % (proj_name, seed))
-            plots.plot_frac_entropy_explained_by(mi, "%s CI with assembly" % proj_name, fig_name)
+            plots.plot_frac_entropy_explained_by(*mi, "%s CI with assembly" % proj_name, fig_name)
             # gathering data for a simplified plot (not the best looking code... but it does the job)
-            plot_args_dim = topology.assembly_membership_probability(gids, assembly_grp, binned_gids, bin_centers, bin_min_n)
+            plot_args_dim = topology.assembly_membership_probability(gids, assembly_grp, bin_centers, bin_idx, bin_min_n)
             for i in range(len(plot_args_dim) - 1):
                 for assembly_id in list(plot_args_dim[0].keys()):
                     plot_args[i][proj_name][assembly_id] = plot_args_dim[i][assembly_id][assembly_id]
@@ -129,16 +166,14 @@ def assembly_prob_mi_from_proj_ci(assembly_grp_dict, conn_matrices, gids, fig_pa
 def assembly_prob_mi_from_patterns(assembly_grp_dict, pattern_indegrees, gids, fig_path,
                                    n_bins=21, bin_min_n=10, sign_th=2):
     """Plots assembly probabilities and (relative) fraction of entropy explained from pattern indegrees"""
-    binned_gids, bin_centers, bin_idx = topology.bin_gids_by_innervation(pattern_indegrees, gids, n_bins)
-    for seed, assembly_grp in assembly_grp_dict.items():
-        plot_args = topology.assembly_membership_probability(gids, assembly_grp, binned_gids, bin_centers, bin_min_n)
+    results = _assembly_prob_mi_across_seeds(assembly_grp_dict, {seed: (gids, pattern_indegrees)
+                                                                 for seed in assembly_grp_dict},
+                                             n_bins, bin_min_n, sign_th)
+    for seed, (plot_args, mi) in results.items():
         fig_name = os.path.join(fig_path, "assembly_prob_from_patterns_%s.png" % seed)
         plots.plot_assembly_prob_from(*plot_args, "In degree from patterns", "patterns", fig_name)
-
-        mi = topology.assembly_rel_frac_entropy_explained(gids, assembly_grp, bin_centers, bin_idx,
-                                                          seed, bin_min_n, sign_th)
         fig_name = os.path.join(fig_path, "frac_entropy_explained_by_patterns_%s.png" % seed)
-        plots.plot_frac_entropy_explained_by(mi, "Innervation by pattern", fig_name)
+        plots.plot_frac_entropy_explained_by(*mi, "Innervation by pattern", fig_name)
 
 
 def assembly_efficacy(config, assembly_grp_dict):
@@ -146,11 +181,25 @@ def assembly_efficacy(config, assembly_grp_dict):
     c = utils.get_bluepy_circuit_from_root_path(config.root_path)
     # get all rhos in one go and then index them as needed
     rhos = utils.get_rho0s(c, config.node_pop, config.target, config.edge_pop)
+    # convert them to (pre_gid x post_gid) sparse matrices of synapse counts (one for the depressed and one for the
+    # potentiated state, the only two that `plots.plot_efficacy()` uses) so that getting the synapses within
+    # an assembly is a sparse submatrix lookup, instead of scanning all of them
+    pre_gids, post_gids, rho = rhos["pre_gid"].to_numpy(), rhos["post_gid"].to_numpy(), rhos["rho"].to_numpy()
+    gids = np.unique(np.concatenate([pre_gids, post_gids]))
+    pre_idx, post_idx = np.searchsorted(gids, pre_gids), np.searchsorted(gids, post_gids)
+    rho_values, rho_mats = [0, 1], []
+    for rho_value in rho_values:
+        mask = rho == rho_value
+        rho_mats.append(coo_matrix((np.ones(np.count_nonzero(mask), dtype=int), (pre_idx[mask], post_idx[mask])),
+                                   shape=(len(gids), len(gids))).tocsr())
 
     for seed, assembly_grp in tqdm(assembly_grp_dict.items(), desc="Getting efficacies"):
-        efficacies = {assembly.idx[0]: rhos.loc[rhos["pre_gid"].isin(assembly.gids)
-                                                & rhos["post_gid"].isin(assembly.gids), "rho"].value_counts()
-                      for assembly in assembly_grp.assemblies}
+        efficacies = {}
+        for assembly in assembly_grp.assemblies:
+            idx = np.searchsorted(gids, assembly.gids)
+            idx = idx[gids[np.minimum(idx, len(gids) - 1)] == assembly.gids]
+            efficacies[assembly.idx[0]] = pd.Series([rho_mat[idx][:, idx].sum() for rho_mat in rho_mats],
+                                                    index=rho_values)
         fig_name = os.path.join(config.fig_path, "efficacy_%s.png" % seed)
         plots.plot_efficacy(efficacies, fig_name)
 
@@ -174,20 +223,20 @@ def assembly_simplex_counts(assembly_grp_dict, conn_mat, fig_path):
 def assembly_prob_mi_from_indegree(assembly_grp_dict, conn_mat, fig_path, n_bins=21, bin_min_n=10, sign_th=2):
     """Plots assembly probabilities and (relative) fraction of entropy explained from indegrees"""
     gids = conn_mat.gids
-    for seed, assembly_grp in assembly_grp_dict.items():
-        assembly_indegrees = {assembly.idx[0]: conn_mat.degree(assembly.gids, gids)
-                              for assembly in assembly_grp.assemblies}
-        binned_gids, bin_centers, bin_idx = topology.bin_gids_by_innervation(assembly_indegrees, gids, n_bins)
-
-        plot_args = topology.assembly_membership_probability(gids, assembly_grp, binned_gids, bin_centers, bin_min_n)
-        palette = {assembly.idx[0]: "pre_assembly_color" for assembly in assembly_grp.assemblies}
+    # get indegrees from all assemblies (across seeds) in one go
+    assemblies = [(seed, assembly) for seed, assembly_grp in assembly_grp_dict.items()
+                  for assembly in assembly_grp.assemblies]
+    indegrees = conn_mat.group_degrees([assembly.gids for _, assembly in assemblies], gids)
+    innervations = {seed: (gids, {}) for seed in assembly_grp_dict}
+    for i, (seed, assembly) in enumerate(assemblies):
+        innervations[seed][1][assembly.idx[0]] = indegrees[:, i]
+    results = _assembly_prob_mi_across_seeds(assembly_grp_dict, innervations, n_bins, bin_min_n, sign_th)
+    for seed, (plot_args, mi) in results.items():
+        palette = {assembly.idx[0]: "pre_assembly_color" for assembly in assembly_grp_dict[seed].assemblies}
         fig_name = os.path.join(fig_path, "assembly_prob_from_indegree_%s.png" % seed)
         plots.plot_assembly_prob_from(*plot_args, "In degree", palette, fig_name)
-
-        mi = topology.assembly_rel_frac_entropy_explained(gids, assembly_grp, bin_centers, bin_idx,
-                                                          seed, bin_min_n, sign_th)
         fig_name = os.path.join(fig_path, "frac_entropy_explained_by_recurrent_innervation_%s.png" % seed)
-        plots.plot_frac_entropy_explained_by(mi, "Innervation by assembly", fig_name)
+        plots.plot_frac_entropy_explained_by(*mi, "Innervation by assembly", fig_name)
 
 
 def assembly_prob_mi_from_sinks(assembly_grp_dict, conn_mat, palette, fig_path, n_bins=21, bin_min_n=10, sign_th=2):
@@ -202,19 +251,19 @@ def assembly_prob_mi_from_sinks(assembly_grp_dict, conn_mat, palette, fig_path,
         for assembly in tqdm(assembly_grp.assemblies, desc="Getting assembly simplex lists"):
             simplex_list = conn_mat.simplex_list(assembly.gids, gids)
             for dim in dims:
-                sink_counts, _ = np.histogram(simplex_list[dim][:, -1], np.arange(len(gids) + 1))
+                sink_counts = np.bincount(simplex_list[dim][:, -1].astype(np.intp), minlength=len(gids))
                 assembly_simplices[dim][assembly.idx[0]] = sink_counts
 
         plot_args = [{dim: {} for dim in dims}, {dim: {} for dim in dims}, {dim: {} for dim in dims}, {dim: {} for dim in dims}]
         for dim in dims:
-            binned_gids, bin_centers, bin_idx = topology.bin_gids_by_innervation(assembly_simplices[dim], gids, n_bins)
+            bin_centers, bin_idx = topology.bin_gids_by_innervation(assembly_simplices[dim], gids, n_bins)
             # getting MI matrices for all dimensions:
             mi = topology.assembly_rel_frac_entropy_explained(gids, assembly_grp, bin_centers, bin_idx,
                                                               seed, bin_min_n, sign_th)
             fig_name = os.path.join(fig_path, "frac_entropy_explained_by_%iDsimplex_sinks_%s.png" % (dim, seed))
-            plots.plot_frac_entropy_explained_by(mi, "(Generalized) Innervation by assembly", fig_name)
+            plots.plot_frac_entropy_explained_by(*mi, "(Generalized) Innervation by assembly", fig_name)
             # gathering data for a simplified plot (not the best looking code... but it does the job)
-            plot_args_dim = topology.assembly_membership_probability(gids, assembly_grp, binned_gids, bin_centers, bin_min_n)
+            plot_args_dim = topology.assembly_membership_probability(gids, assembly_grp, bin_centers, bin_idx, bin_min_n)
             for i in range(len(plot_args_dim)-1):
                 for assembly_id in list(plot_args_dim[0].keys()):
                     plot_args[i][dim][assembly_id] = plot_args_dim[i][assembly_id][assembly_id]
@@ -225,67 +274,82 @@ def assembly_prob_mi_from_sinks(assembly_grp_dict, conn_mat, palette, fig_path,
         plots.plot_assembly_prob_from(*plot_args, "Generalized in degree (#simplex sinks)", palette, fig_name, True)
 
 
-def assembly_prob_mi_from_syn_nnd(assembly_grp_dict, h5f_name, fig_path, n_bins=21, bin_min_n=10, sign_th=2):
-    """Plots assembly probabilities and (relative) fraction of entropy explained from
-    synapse nearest neighbour distance 'strength' (converts low distances to high 'strength' values)
-    (Because these calculations are not parallelized yet it's loading data from HDF5)"""
+def load_syn_nnds(assembly_grp_dict, h5f_name):
+    """Loads synapse nearest neighbour results (for all seeds that have them) from HDF5 in one go,
+    so that the functions below don't have to read them again and again"""
     with h5py.File(h5f_name, "r") as h5f:
         h5_keys = list(h5f.keys())
+    syn_nnds = {}
     for seed, assembly_grp in assembly_grp_dict.items():
         prefix = "%s_syn_nnd" % seed
         if prefix in h5_keys:  # since this runs forever one might not have the results for all seeds
-            syn_nnds = utils.load_syn_nnd_from_h5(h5f_name, len(assembly_grp), prefix=prefix)
-            # index out synapse nearest neighbour "strength" from MI DF
-            assembly_idx = syn_nnds.columns.get_level_values(0).unique().to_numpy()
-            df = syn_nnds.loc[:, (assembly_idx, DSET_CLST)]
-            df.columns = [int(assembly_id.split("assembly")[1]) for assembly_id in assembly_idx]
-            df = df.loc[:, np.sort(df.columns.to_numpy())]  # order matters for colors...
-            gids = df.index.to_numpy()
-            # from here it's the same as the other functions with dicts built on the fly
-            binned_gids, bin_centers, bin_idx = topology.bin_gids_by_innervation(df, gids, n_bins)
-
-            plot_args = topology.assembly_membership_probability(gids, assembly_grp, binned_gids, bin_centers, bin_min_n)
-            palette = {assembly.idx[0]: "pre_assembly_color" for assembly in assembly_grp.assemblies}
-            fig_name = os.path.join(fig_path, "assembly_prob_from_syn_nnd_%s.png" % seed)
-            plots.plot_assembly_prob_from(*plot_args, "Zscored synapse nnd. strength", palette, fig_name)
+            syn_nnds[seed] = utils.load_syn_nnd_from_h5(h5f_name, len(assembly_grp), prefix=prefix)
+    return syn_nnds
 
-            mi = topology.assembly_rel_frac_entropy_explained(gids, assembly_grp, bin_centers, bin_idx,
-                                                              seed, bin_min_n, sign_th)
-            fig_name = os.path.join(fig_path, "frac_entropy_explained_by_syn_nnd_%s.png" % seed)
-            plots.plot_frac_entropy_explained_by(mi, "Synapse nnd. strength from assembly", fig_name)
+
+def _get_syn_nnd_dset(syn_nnds, dset):
+    """Indexes out `dset` for all assemblies from the (MultiIndex) syn nnd. DataFrame as a (n_gids, n_assemblies)
+    array + assembly IDs (sorted, as order matters for colors...), so that all the indexing afterwards
+    is done on (column-major, so the columns are contiguous) numpy arrays and not on DataFrames"""
+    assembly_names = syn_nnds.columns.get_level_values(0).unique().to_numpy()
+    assembly_idx = np.fromiter((assembly_name.rsplit("assembly", 1)[-1] for assembly_name in assembly_names),
+                               dtype=int, count=len(assembly_names))
+    sort_idx = np.argsort(assembly_idx)
+    data = syn_nnds.xs(dset, axis=1, level=1)[assembly_names[sort_idx]].to_numpy()
+    return assembly_idx[sort_idx], np.asfortranarray(data)
+
+
+def assembly_prob_mi_from_syn_nnd(assembly_grp_dict, h5f_name, fig_path, n_bins=21, bin_min_n=10, sign_th=2,
+                                  syn_nnds_dict=None):
+    """Plots assembly probabilities and (relative) fraction of entropy explained from
+    synapse nearest neighbour distance 'strength' (converts low distances to high 'strength' values)
+    (Because these calculations are not parallelized yet it's loading data from HDF5,
+    unless it's passed in `syn_nnds_dict` (see `load_syn_nnds()` above))"""
+    if syn_nnds_dict is None:
+        syn_nnds_dict = load_syn_nnds(assembly_grp_dict, h5f_name)
+    innervations = {}
+    for seed, syn_nnds in syn_nnds_dict.items():
+        # index out synapse nearest neighbour "strength" from MI DF
+        assembly_idx, strengths = _get_syn_nnd_dset(syn_nnds, DSET_CLST)
+        # from here it's the same as the other functions with dicts built on the fly
+        innervations[seed] = (syn_nnds.index.to_numpy(), {assembly_id: strengths[:, i]
+                                                          for i, assembly_id in enumerate(assembly_idx)})
+    results = _assembly_prob_mi_across_seeds(assembly_grp_dict, innervations, n_bins, bin_min_n, sign_th)
+    for seed, (plot_args, mi) in results.items():
+        palette = {assembly.idx[0]: "pre_assembly_color" for assembly in assembly_grp_dict[seed].assemblies}
+        fig_name = os.path.join(fig_path, "assembly_prob_from_syn_nnd_%s.png" % seed)
+        plots.plot_assembly_prob_from(*plot_args, "Zscored synapse nnd. strength", palette, fig_name)
+        fig_name = os.path.join(fig_path, "frac_entropy_explained_by_syn_nnd_%s.png" % seed)
+        plots.plot_frac_entropy_explained_by(*mi, "Synapse nnd. strength from assembly", fig_name)
 
 
 def assembly_prob_mi_from_indegree_groupedby_syn_nnd(assembly_grp_dict, h5f_name, fig_path,
-                                                     n_bins=21, bin_min_n=10, sign_th=2, p_th=0.05):
+                                                     n_bins=21, bin_min_n=10, sign_th=2, p_th=0.05,
+                                                     syn_nnds_dict=None):
     """Plots fraction of conditional entropy explained from synapse nearest neighbour distance 'strength'
     (conditioned on indegree) and (within) assembly probabilities from indegrees grouped by
     sign. synapse nearest neighbour distance 'strength' (See doc. of `assembly_prob_mi_from_syn_nnd` above.)"""
-    with h5py.File(h5f_name, "r") as h5f:
-        h5_keys = list(h5f.keys())
+    if syn_nnds_dict is None:
+        syn_nnds_dict = load_syn_nnds(assembly_grp_dict, h5f_name)
     for seed, assembly_grp in assembly_grp_dict.items():
-        prefix = "%s_syn_nnd" % seed
-        if prefix in h5_keys:  # since this runs forever one might not have the results for all seeds
-            syn_nnds = utils.load_syn_nnd_from_h5(h5f_name, len(assembly_grp), prefix=prefix)
-            assembly_idx = syn_nnds.columns.get_level_values(0).unique().to_numpy()
+        if seed in syn_nnds_dict:
+            syn_nnds = syn_nnds_dict[seed]
+            assembly_idx, strengths = _get_syn_nnd_dset(syn_nnds, DSET_CLST)
+            _, indegrees = _get_syn_nnd_dset(syn_nnds, DSET_DEG)
             # quickly check if the syn nnd. strength and indegree are correlated
             fig_name = os.path.join(fig_path, "syn_nnd_indegree_corr_%s.png" % seed)
-            plots.plot_joint_dists(syn_nnds.loc[:, (assembly_idx, DSET_CLST)].to_numpy().flatten(),
-                                   syn_nnds.loc[:, (assembly_idx, DSET_DEG)].to_numpy().flatten(),
-                                   DSET_CLST, DSET_DEG, fig_name)
+            plots.plot_joint_dists(strengths.flatten(), indegrees.flatten(), DSET_CLST, DSET_DEG, fig_name)
 
             # split MI DF to 3 different ones (as that's what the helper functions can deal with...)
-            df = syn_nnds.loc[:, (assembly_idx, DSET_PVALUE)]
-            df.columns = [int(assembly_id.split("assembly")[1]) for assembly_id in assembly_idx]
-            sign = (df < p_th).astype(int)
-            df = syn_nnds.loc[:, (assembly_idx, DSET_CLST)]
-            df.columns = [int(assembly_id.split("assembly")[1]) for assembly_id in assembly_idx]
-            sign[df < 0] *= -1  # `sign` now stores 1 for sign. clustering, -1 for sign. avoidance
-            gids = df.index.to_numpy()
-            _, _, bin_idx = topology.bin_gids_by_innervation(df, gids, n_bins)
-            df = syn_nnds.loc[:, (assembly_idx, DSET_DEG)]
-            df.columns = [int(assembly_id.split("assembly")[1]) for assembly_id in assembly_idx]
-            df = df.loc[:, np.sort(df.columns.to_numpy())]  # order matters for colors...
-            _, bin_centers, bin_idx_cond = topology.bin_gids_by_innervation(df, gids, n_bins)
+            _, pvalues = _get_syn_nnd_dset(syn_nnds, DSET_PVALUE)
+            sign = (pvalues < p_th).astype(int)
+            sign[strengths < 0] *= -1  # `sign` now stores 1 for sign. clustering, -1 for sign. avoidance
+            sign = {assembly_id: sign[:, i] for i, assembly_id in enumerate(assembly_idx)}
+            gids = syn_nnds.index.to_numpy()
+            strengths = {assembly_id: strengths[:, i] for i, assembly_id in enumerate(assembly_idx)}
+            _, bin_idx = topology.bin_gids_by_innervation(strengths, gids, n_bins)
+            indegrees = {assembly_id: indegrees[:, i] for i, assembly_id in enumerate(assembly_idx)}
+            bin_centers, bin_idx_cond = topology.bin_gids_by_innervation(indegrees, gids, n_bins)
 
             sign_keys = {"sing. avoidance": -1, "non-sign.": 0, "sign. 'clustering'": 1}
             plot_args = topology.cond_assembly_membership_probability(gids, assembly_grp, bin_centers, bin_idx_cond,
@@ -296,7 +360,7 @@ def assembly_prob_mi_from_indegree_groupedby_syn_nnd(assembly_grp_dict, h5f_name
 
             mi = topology.assembly_cond_frac_entropy_explained(gids, assembly_grp, bin_idx, bin_idx_cond, seed, sign_th)
             fig_name = os.path.join(fig_path, "cond_frac_entropy_explained_nnd|indegree_%s.png" % seed)
-            plots.plot_frac_entropy_explained_by(mi, "Synapse nnd. strength | indegree from assembly", fig_name)
+            plots.plot_frac_entropy_explained_by(*mi, "Synapse nnd. strength | indegree from assembly", fig_name)
 
 
 def main(config, assembly_grp_dict, plastic=False):
@@ -312,8 +376,10 @@ def main(config, assembly_grp_dict, plastic=False):
     assembly_simplex_counts(assembly_grp_dict, conn_mat, fig_path)
     assembly_prob_mi_from_indegree(assembly_grp_dict, conn_mat, fig_path)
     assembly_prob_mi_from_sinks(assembly_grp_dict, conn_mat, {2: "gray", 3: "black", 4: "assembly_color"}, fig_path)
-    assembly_prob_mi_from_syn_nnd(assembly_grp_dict, config.h5f_name, fig_path)
-    assembly_prob_mi_from_indegree_groupedby_syn_nnd(assembly_grp_dict, config.h5f_name, fig_path)
+    syn_nnds_dict = load_syn_nnds(assembly_grp_dict, config.h5f_name)
+    assembly_prob_mi_from_syn_nnd(assembly_grp_dict, config.h5f_name, fig_path, syn_nnds_dict=syn_nnds_dict)
+    assembly_prob_mi_from_indegree_groupedby_syn_nnd(assembly_grp_dict, config.h5f_name, fig_path,
+                                                     syn_nnds_dict=syn_nnds_dict)
 
 
 if __name__ == "__main__":
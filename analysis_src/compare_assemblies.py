@@ -22,9 +22,9 @@ def get_assembly_similarities(assembly_grp1, assembly_grp2):
     gids1, gids2 = assembly_grp1.all, assembly_grp2.all
     gids = np.union1d(gids1, gids2)
     assembly_idx1 = np.zeros((len(assembly_grp1), len(gids)), dtype=int)
-    assembly_idx1[:, np.in1d(gids, gids1, assume_unique=True)] = assembly_grp1.as_bool().transpose().astype(int)
+    assembly_idx1[:, utils.isin_sorted(gids, gids1)] = assembly_grp1.as_bool().transpose().astype(int)
     assembly_idx2 = np.zeros((len(assembly_grp2), len(gids)), dtype=int)
-    assembly_idx2[:, np.in1d(gids, gids2, assume_unique=True)] = assembly_grp2.as_bool().transpose().astype(int)
+    assembly_idx2[:, utils.isin_sorted(gids, gids2)] = assembly_grp2.as_bool().transpose().astype(int)
     return 1 - cdist(assembly_idx1, assembly_idx2, "jaccard")
 
 
@@ -65,8 +65,8 @@ def consensus_at_fraction_thresholds(consensus_assembly_grp, frac_ths):
 def consensus_vs_average_assembly_similarity(config_path, frac_ths):
     """Loads in consensus and average assemblies and gets their Jaccard similarity"""
     config = Config(config_path)
-    assembly_grp_dict, _ = utils.load_assemblies_from_h5(config.h5f_name, config.h5_prefix_avg_assemblies)
-    avg_assembly_grp = assembly_grp_dict["seed_average"]
+    _, avg_assembly_grp = next(utils.iter_assemblies_from_h5(config.h5f_name, config.h5_prefix_avg_assemblies,
+                                                             seeds=["seed_average"]))
     consensus_assemblies = utils.load_consensus_assemblies_from_h5(config.h5f_name, config.h5_prefix_consensus_assemblies)
     consensus_assembly_grp = utils.consensus_dict2assembly_grp(consensus_assemblies)
 
@@ -86,8 +86,8 @@ def consensus_vs_average_assembly_similarity(config_path, frac_ths):
 def consensus_vs_average_assembly_composition(config_path, avg_assembly_id, consensus_assembly_id):
     """Checks if cells in consensus union are present in the average as well"""
     config = Config(config_path)
-    assembly_grp_dict, _ = utils.load_assemblies_from_h5(config.h5f_name, config.h5_prefix_avg_assemblies)
-    avg_assembly_grp = assembly_grp_dict["seed_average"]
+    _, avg_assembly_grp = next(utils.iter_assemblies_from_h5(config.h5f_name, config.h5_prefix_avg_assemblies,
+                                                             seeds=["seed_average"]))
     avg_gids = avg_assembly_grp.loc(avg_assembly_id).gids
     consensus_assemblies = utils.load_consensus_assemblies_from_h5(config.h5f_name, config.h5_prefix_consensus_assemblies)
     consensus_assembly = consensus_assemblies["cluster%i" % consensus_assembly_id]
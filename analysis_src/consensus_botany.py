@@ -56,8 +56,8 @@ def consensus_botany(assembly_grp, conn_mat, fig_path):
     fig_name = os.path.join(fig_path, "consensus_assemblies.png")
     plots.plot_assemblies(assembly_grp.as_bool(), core_idx, assembly_grp.all, nrn_df.set_index("gid"), fig_name)
 
-    core_mtypes = [mtypes[np.in1d(gids, assembly.gids, assume_unique=True)] for assembly in assembly_grp.assemblies]
-    union_mtypes = [mtypes[np.in1d(gids, assembly.union.gids, assume_unique=True)] for assembly in assembly_grp.assemblies]
+    core_mtypes = [mtypes[utils.isin_sorted(gids, assembly.gids)] for assembly in assembly_grp.assemblies]
+    union_mtypes = [mtypes[utils.isin_sorted(gids, assembly.union.gids)] for assembly in assembly_grp.assemblies]
     plots.plot_consensus_mtypes(mtypes, core_mtypes, union_mtypes, os.path.join(fig_path, "consensus_mtypes.png"))
 
     simplex_counts, simplex_counts_control = simplex_counts_consensus_instantiations(assembly_grp, conn_mat)
@@ -2,8 +2,22 @@
 
 from assemblyfire.version import __version__
 from assemblyfire.config import Config
-from assemblyfire.spikes import SpikeMatrixGroup
-from assemblyfire.assemblies import Assembly, AssemblyGroup, ConsensusAssembly
-from assemblyfire.topology import AssemblyTopology
-from assemblyfire.syn_nnd import SynNNDResults
 
+# the rest are imported lazily (PEP 562) as they pull in heavy dependencies (scipy, sklearn, conntility, h5py...)
+_LAZY_IMPORTS = {"SpikeMatrixGroup": "assemblyfire.spikes",
+                 "Assembly": "assemblyfire.assemblies",
+                 "AssemblyGroup": "assemblyfire.assemblies",
+                 "ConsensusAssembly": "assemblyfire.assemblies",
+                 "AssemblyTopology": "assemblyfire.topology",
+                 "SynNNDResults": "assemblyfire.syn_nnd"}
+
+
+def __getattr__(name):
+    if name in _LAZY_IMPORTS:
+        import importlib
+        return getattr(importlib.import_module(_LAZY_IMPORTS[name]), name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + list(_LAZY_IMPORTS.keys()))
@@ -52,8 +52,9 @@ def __to_h5_1p0__(data, h5, prefix=None):
     assert data.label not in grp, "{0} already in {1}/{2}".format(data.label, h5.filename, prefix)
     grp_out = grp.create_group(data.label)
 
-    grp_out.create_dataset(strings["gids"], data=data.all)
-    grp_out.create_dataset(strings["bool_index"], data=data.as_bool())
+    # (sorted) gids compress well after byte shuffling, and so does the sparse bool matrix of memberships
+    grp_out.create_dataset(strings["gids"], data=data.all, compression="gzip", shuffle=True)
+    grp_out.create_dataset(strings["bool_index"], data=data.as_bool(), compression="gzip")
     for k, v in data.metadata.items():
         grp_out.attrs[k] = v
 
@@ -66,6 +67,14 @@ def __to_h5_1p0__(data, h5, prefix=None):
     return prefix
 
 
+def __read_dset__(dset):
+    """Reads a whole h5py Dataset into a preallocated array with `read_direct()` (instead of `dset[:]`)"""
+    data = np.empty(dset.shape, dtype=dset.dtype)
+    if data.size:
+        dset.read_direct(data)
+    return data
+
+
 def __from_h5_1p0__(h5, group_name, prefix=None):
     strings = __h5_strings__["1.0"]
     if prefix is None:
@@ -73,12 +82,12 @@ def __from_h5_1p0__(h5, group_name, prefix=None):
 
     prefix_grp = h5[prefix]
     assert group_name in prefix_grp.keys()
-    all_neurons = np.unique(np.hstack([prefix_grp[k][strings["gids"]][:]
+    all_neurons = np.unique(np.hstack([__read_dset__(prefix_grp[k][strings["gids"]])
                                        for k in prefix_grp.keys()
                                        if k not in __RESERVED__]))
 
-    R = prefix_grp[group_name][strings["gids"]][:]
-    M = prefix_grp[group_name][strings["bool_index"]][:]
+    R = __read_dset__(prefix_grp[group_name][strings["gids"]])
+    M = __read_dset__(prefix_grp[group_name][strings["bool_index"]])
     metadata = dict(prefix_grp[group_name].attrs)
     orig_indices = metadata.get(strings["indices"], list(range(M.shape[1])))
 
@@ -300,7 +309,8 @@ class AssemblyGroup(object):
             raise ValueError("Specify either a list of Assembly objects or a boolean matrix of assembly membership!")
 
         idx_type = [isinstance(asmbl.idx, tuple) for asmbl in self.assemblies]
-        assert np.mod(np.sum(idx_type), len(idx_type)) == 0, "Assembly.idx must be all tuples or all scalar in a group!"
+        assert not len(idx_type) or np.mod(np.sum(idx_type), len(idx_type)) == 0, \
+            "Assembly.idx must be all tuples or all scalar in a group!"
         self.label = label
         self.all = all_gids
         if metadata is None:
@@ -436,6 +446,13 @@ class AssemblyGroup(object):
         with h5py.File(fn, "r") as h5:
             return read_func(h5, group_name, prefix=prefix)
 
+    @classmethod
+    def from_open_h5(cls, h5, group_name, prefix=None):
+        """Same as `from_h5()` above but reads from an already opened (h5py.File) file
+        (to not reopen it for every group when reading several ones)"""
+        read_func = cls.h5_read_func[h5.attrs.get(__str_io_version__, __io_version__)]
+        return read_func(h5, group_name, prefix=prefix)
+
     def aligned_intersections(self, other=None):
         """
         Intersections along the diagonal
@@ -545,10 +562,8 @@ class ConsensusAssembly(Assembly):
         :return: The assembly representing the union of all stochastic instantiations of the consensus assembly
         """
         assert len(self.instantiations) > 0, "Need to specify at least one Assembly for a consensus"
-        union_view = self.instantiations[0]
-        for instance in self.instantiations[1:]:
-            union_view = union_view + instance
-        return union_view
+        # a single `np.unique()` on all gids (instead of pairwise unions of the growing union with each instantiation)
+        return Assembly(np.unique(np.concatenate([instance.gids for instance in self.instantiations])))
 
     def __expected_number_of_instantiations__(self):
         """
@@ -569,10 +584,9 @@ class ConsensusAssembly(Assembly):
         return binom(N, p)
 
     def __number_of_times_contained__(self):
-        res = []
-        for assembly in self.instantiations:
-            res.append(np.in1d(self.union.gids, assembly.gids))
-        return np.vstack(res).sum(axis=0)
+        # (sorted) union gids are looked up with binary search, and the hits of all instantiations are counted at once
+        all_gids = np.concatenate([np.unique(assembly.gids) for assembly in self.instantiations])
+        return np.bincount(np.searchsorted(self.union.gids, all_gids), minlength=len(self.union.gids))
 
 
 def consensus_over_seeds(assembly_grp_dict, h5f_name, h5_prefix, fig_path,
@@ -88,8 +88,7 @@ def pairwise_correlation_xy(x, y):
 def _convert_clusters(clusters):
     """Convert cluster vector into a matrix form for `cdist()`"""
     sparse_clusters = np.zeros((len(np.unique(clusters)), clusters.shape[0]), dtype=int)
-    for i in np.unique(clusters):
-        sparse_clusters[i, clusters == i] = 1
+    sparse_clusters[clusters, np.arange(clusters.shape[0])] = 1  # (cluster labels are row indices)
     return sparse_clusters
 
 
@@ -319,12 +318,16 @@ def syn_nearest_neighbour_distances(gid, mpdc, syn_loc_df, assembly_grp, same_se
     param n_ctrls (int): number of controls to use for t-test
     """
     results = {}
+    # (hash based) pandas lookups in the index of the synapses, and the unique presynaptic gids only computed once
+    pre_gids = syn_loc_df.index
+    gids = np.unique(pre_gids.to_numpy())
+    unique_pre_gids = pd.Index(gids)
     for assembly in assembly_grp:
         results[("gid", "gid")] = gid
         results[("assembly%i" % assembly.idx[0], DSET_MEMBER)] = gid in assembly.gids
 
-        from_assembly = np.in1d(syn_loc_df.index.to_numpy(), assembly.gids)
-        from_assembly_count = len(np.intersect1d(syn_loc_df.index.to_numpy(), assembly.gids))
+        from_assembly = pre_gids.isin(assembly.gids)
+        from_assembly_count = np.count_nonzero(unique_pre_gids.isin(assembly.gids))
         if from_assembly.sum() == 0:
             results[("assembly%i" % assembly.idx[0], DSET_CLST)]: np.NaN
             results[("assembly%i" % assembly.idx[0], DSET_PVALUE)]: np.NaN
@@ -334,12 +337,11 @@ def syn_nearest_neighbour_distances(gid, mpdc, syn_loc_df, assembly_grp, same_se
         nnd_data = np.nanmin(pd_data, axis=0)
 
         nnd_ctrl = []
-        gids = np.unique(syn_loc_df.index.to_numpy())
         hash_ = md5(assembly.gids)
         assembly_seed = np.mod(int(hash_.hexdigest(), 16), 1000)
         for seed in range(n_ctrls):
             np.random.seed(seed * (assembly_seed + gid))
-            from_ctrl = np.in1d(syn_loc_df.index.to_numpy(), np.random.choice(gids, from_assembly_count, replace=False))
+            from_ctrl = pre_gids.isin(np.random.choice(gids, from_assembly_count, replace=False))
             pd_ctrl = mpdc.path_distances(syn_loc_df[from_ctrl], same_section_only=same_section_only)
             pd_ctrl[pd_ctrl == 0] = np.NaN
             nnd_ctrl.append(np.nanmin(pd_ctrl, axis=0))
@@ -357,20 +359,17 @@ def syn_nearest_neighbour_distances(gid, mpdc, syn_loc_df, assembly_grp, same_se
 def _create_lookups(loc_df, assembly_grp):
     """Create dicts with synapse idx, and fraction of those (compared to total) for all assemblies
     in the `assembly_grp`. (As neurons can be part of more than 1 assembly, `fracs` won't add up to 1)"""
-    syn_idx, fracs, all_assembly_syn_idx = {}, {}, []
-    nsyns, all_pre_gids = len(loc_df), loc_df["pre_gid"].to_numpy()
+    syn_idx, fracs = {}, {}
+    nsyns, all_pre_gids = len(loc_df), pd.Index(loc_df["pre_gid"].to_numpy())
+    from_any_assembly = np.zeros(nsyns, dtype=bool)
     for assembly in assembly_grp:
-        idx = np.in1d(all_pre_gids, assembly.gids)
+        idx = all_pre_gids.isin(assembly.gids)  # hash based lookup (instead of sorting all pre gids in `np.in1d()`)
         assembly_frac = idx.sum() / len(idx)
         fracs["assembly%i" % assembly.idx[0]] = assembly_frac
-        assembly_idx = np.nonzero(idx)[0]
-        syn_idx["assembly%i" % assembly.idx[0]] = assembly_idx
-        all_assembly_syn_idx.append(assembly_idx)
+        syn_idx["assembly%i" % assembly.idx[0]] = np.nonzero(idx)[0]
+        from_any_assembly |= idx  # neurons can be part of more than 1 assemblies...
     # finds synapses that aren't coming from any assembly
-    all_assembly_syn_idx = np.unique(np.concatenate(all_assembly_syn_idx))  # neurons can be part of more than 1 assemblies...
-    tmp = np.arange(nsyns)
-    non_assembly_syn_idx = tmp[np.in1d(tmp, all_assembly_syn_idx, assume_unique=True, invert=True)]
-    assert (len(all_assembly_syn_idx) + len(non_assembly_syn_idx) == nsyns), "Synapse numbers don't add up..."
+    non_assembly_syn_idx = np.nonzero(~from_any_assembly)[0]
     syn_idx["non_assembly"] = non_assembly_syn_idx
     fracs["non_assembly"] = len(non_assembly_syn_idx) / nsyns
     return syn_idx, fracs
@@ -7,6 +7,7 @@ import os
 import logging
 from tqdm import tqdm
 import numpy as np
+import pandas as pd
 
 from assemblyfire.config import Config
 import assemblyfire.utils as utils
@@ -22,20 +23,42 @@ DSET_CLST = "strength"
 DSET_PVALUE = "pvalue"
 
 
-def _get_degree_sorted_assembly_gids(c, node_pop, conn_mat, assembly, mtype_list, n_samples, pre_assembly=None):
-    """Helper function to select indegree sorted postsynaptic gids from assembly"""
-    if pre_assembly is None:
-        indegrees = conn_mat.degree(assembly.gids, kind="in")
-    else:
-        indegrees = conn_mat.degree(pre_gids=pre_assembly.gids, post_gids=assembly.gids, kind="in")
-    sorted_assembly_gids = assembly.gids[np.argsort(indegrees)[::-1]]
-    mtypes = utils.get_node_properties(c, node_pop, sorted_assembly_gids, "mtype")  # could be loaded from `conn_mat`
-    return mtypes.loc[mtypes.isin(mtype_list)].index.to_numpy()[:n_samples]
+def _top_k_idx(values, k):
+    """Indices of the `k` largest `values` in descending order
+    (`np.argpartition()` + sorting only the top `k` instead of sorting all `values`)"""
+    if k >= len(values):
+        return np.argsort(values)[::-1]
+    top_idx = np.argpartition(values, len(values) - k)[len(values) - k:]
+    return top_idx[np.argsort(values[top_idx])[::-1]]
+
+
+def _get_mtype_gids(c, node_pop, gids, mtype_list):
+    """Returns (sorted) `gids` with mtypes in `mtype_list` (queried from the circuit once,
+    instead of querying the mtypes of the selected gids again and again for every assembly)"""
+    mtypes = utils.get_node_properties(c, node_pop, gids, "mtype")  # could be loaded from `conn_mat`
+    return np.sort(mtypes.loc[mtypes.isin(mtype_list)].index.to_numpy())
+
+
+def _get_assembly_indegrees(conn_mat, assembly_grp):
+    """Gets indegrees from each assembly in the `assembly_grp` for all assembly neurons
+    (as a DataFrame with gids as index and assembly IDs as columns) with a single sparse matrix multiplication
+    (see `topology.py/AssemblyTopology.group_degrees()`) instead of slicing a submatrix for every (pair of) assembly"""
+    return pd.DataFrame(conn_mat.group_degrees([assembly.gids for assembly in assembly_grp.assemblies],
+                                               assembly_grp.all),
+                        index=assembly_grp.all, columns=[assembly.idx[0] for assembly in assembly_grp.assemblies])
+
+
+def _get_degree_sorted_assembly_gids(assembly_indegrees, assembly, mtype_gids, n_samples, pre_assembly=None):
+    """Helper function to select indegree sorted postsynaptic gids (of given mtypes) from assembly"""
+    pre_assembly_id = assembly.idx[0] if pre_assembly is None else pre_assembly.idx[0]
+    indegrees = assembly_indegrees.loc[assembly.gids, pre_assembly_id].to_numpy()
+    # filter mtypes first, so that only the top `n_samples` have to be sorted
+    idx = np.nonzero(utils.isin_sorted(assembly.gids, mtype_gids))[0]
+    return assembly.gids[idx[_top_k_idx(indegrees[idx], n_samples)]]
 
 
-def _get_syn_nnd_degree_sorted_assembly_gids(c, node_pop, syn_nnds, assembly, mtype_list, n_samples,
-                                             pre_assembly=None, p_th=0.05):
-    """Helper function to select indegree sorted postsynaptic gids from assembly
+def _get_syn_nnd_degree_sorted_assembly_gids(syn_nnds, assembly, mtype_gids, n_samples, pre_assembly=None, p_th=0.05):
+    """Helper function to select indegree sorted postsynaptic gids (of given mtypes) from assembly
     (Compared to above there is a preselection og gids by significant synapse nnd. 'strength')"""
     assembly_id = "assembly%i" % pre_assembly.idx[0] if pre_assembly is not None else "assembly%i" % assembly.idx[0]
     df = syn_nnds.loc[:, [(assembly_id, DSET_MEMBER), (assembly_id, DSET_DEG),
@@ -49,25 +72,24 @@ def _get_syn_nnd_degree_sorted_assembly_gids(c, node_pop, syn_nnds, assembly, mt
         df = df.iloc[np.in1d(df.index.to_numpy(), assembly.gids), :]
     df = df.sort_values(DSET_DEG, ascending=False)
     # index out mtypes, and take the first `n_samples`
-    mtypes = utils.get_node_properties(c, node_pop, df.index.to_numpy(), "mtype")
-    return mtypes.loc[mtypes.isin(mtype_list)].index.to_numpy()[:n_samples]
+    gids = df.index.to_numpy()
+    return gids[utils.isin_sorted(gids, mtype_gids)][:n_samples]
 
 
-def _get_cross_degree_sorted_assembly_gids(c, node_pop, conn_mat, cross_assembly_grp, assembly, mtype_list, n_samples):
+def _get_cross_degree_sorted_assembly_gids(assembly_indegrees, cross_assembly_grp, assembly, mtype_gids, n_samples):
     """Similar indegree based helper as above, but works for cross-assembly connections
     (It'll return `n_samples` gids per presynaptic assembly (i.e. `len(cross_assembly_grp)`), not in total...)"""
-    gids = [_get_degree_sorted_assembly_gids(c, node_pop, conn_mat, assembly, mtype_list,
-                                             n_samples, pre_assembly=pre_assembly)
+    gids = [_get_degree_sorted_assembly_gids(assembly_indegrees, assembly, mtype_gids, n_samples,
+                                             pre_assembly=pre_assembly)
             for pre_assembly in cross_assembly_grp.assemblies]
     return np.unique(np.concatenate(gids))
 
 
-def _get_cross_syn_nnd_degree_sorted_assembly_gids(c, node_pop, syn_nnds, cross_assembly_grp, assembly,
-                                                   mtype_list, n_samples):
+def _get_cross_syn_nnd_degree_sorted_assembly_gids(syn_nnds, cross_assembly_grp, assembly, mtype_gids, n_samples):
     """Similar synapse nnd. and indegree based helper as above, but works for cross-assembly connections
     (It'll return `n_samples` gids per presynaptic assembly (i.e. `len(cross_assembly_grp)`), not in total...)"""
-    gids = [_get_syn_nnd_degree_sorted_assembly_gids(c, node_pop, syn_nnds, assembly,
-                                                     mtype_list, n_samples, pre_assembly=pre_assembly)
+    gids = [_get_syn_nnd_degree_sorted_assembly_gids(syn_nnds, assembly, mtype_gids, n_samples,
+                                                     pre_assembly=pre_assembly)
             for pre_assembly in cross_assembly_grp.assemblies]
     return np.unique(np.concatenate(gids))
 
@@ -111,6 +133,7 @@ def run(config_path, debug):
     mtypes, n_samples = config.syn_clustering_mtypes, config.syn_clustering_n_neurons_sample
     cross_assemblies = config.syn_clustering_cross_assemblies
     c = utils.get_bluepy_circuit_from_root_path(config.root_path)
+    mtype_gids = _get_mtype_gids(c, node_pop, conn_mat.gids, mtypes)
 
     L.info(" Detecting synapse clusters and saving them to files")
     for seed, assembly_grp in tqdm(assembly_grp_dict.items(), desc="Iterating over seeds"):
@@ -119,12 +142,13 @@ def run(config_path, debug):
             L.info(" Using saved synapse nnds. (%i cells) for gid selection" % len(syn_nnds))
         except:
             syn_nnds = None
+            assembly_indegrees = _get_assembly_indegrees(conn_mat, assembly_grp)
         # cluster_dfs, cross_cluster_dfs = {}, {}
         for assembly in tqdm(assembly_grp.assemblies, desc="%s syn. clusters" % seed, leave=False):
             if syn_nnds is not None:
-                gids = _get_syn_nnd_degree_sorted_assembly_gids(c, node_pop, syn_nnds, assembly, mtypes, n_samples)
+                gids = _get_syn_nnd_degree_sorted_assembly_gids(syn_nnds, assembly, mtype_gids, n_samples)
             else:
-                gids = _get_degree_sorted_assembly_gids(c, node_pop, conn_mat, assembly, mtypes, n_samples)
+                gids = _get_degree_sorted_assembly_gids(assembly_indegrees, assembly, mtype_gids, n_samples)
             syn_idx = utils.get_syn_idx(utils.get_edgef_name(c, edge_pop), conn_mat.gids, gids)
             loc_df = utils.get_synloc_df(c, syn_idx, edge_pop)
             # create a fake assembly "group" in order to look for *within* assembly clusters only
@@ -154,12 +178,11 @@ def run(config_path, debug):
                         cross_assembly_grp = AssemblyGroup(assembly_lst, all_gids=all_gids)
                         # sample gids (slightly differently) to have high indegree from `cross_assembly_grp`
                         if syn_nnds is not None:
-                            gids = _get_cross_syn_nnd_degree_sorted_assembly_gids(c, node_pop, syn_nnds,
-                                                                                  cross_assembly_grp, assembly,
-                                                                                  mtypes, n_samples)
+                            gids = _get_cross_syn_nnd_degree_sorted_assembly_gids(syn_nnds, cross_assembly_grp,
+                                                                                  assembly, mtype_gids, n_samples)
                         else:
-                            gids = _get_cross_degree_sorted_assembly_gids(c, node_pop, conn_mat, cross_assembly_grp,
-                                                                          assembly, mtypes, n_samples)
+                            gids = _get_cross_degree_sorted_assembly_gids(assembly_indegrees, cross_assembly_grp,
+                                                                          assembly, mtype_gids, n_samples)
                         syn_idx = utils.get_syn_idx(utils.get_edgef_name(c, edge_pop), conn_mat.gids, gids)
                         loc_df = utils.get_synloc_df(c, syn_idx, edge_pop)
                         if debug:
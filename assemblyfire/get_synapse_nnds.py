@@ -26,21 +26,21 @@ def _assembly_group_from_name(config, assembly_grp_name):
         cons_assemblies = utils.load_consensus_assemblies_from_h5(config.h5f_name, config.h5_prefix_consensus_assemblies)
         return utils.consensus_dict2assembly_grp(cons_assemblies)
     elif assembly_grp_name == "seed_average":
-        assembly_grp_dict, _ = utils.load_assemblies_from_h5(config.h5f_name, config.h5_prefix_avg_assemblies)
-        assembly_grp = assembly_grp_dict["seed_average"]
+        _, assembly_grp = next(utils.iter_assemblies_from_h5(config.h5f_name, config.h5_prefix_avg_assemblies,
+                                                             seeds=["seed_average"]))
         for assembly in assembly_grp.assemblies:
             assembly.idx = (assembly.idx, "_average")  # for some reason the str. is not saved/loaded to/from HDF5
         return assembly_grp
     else:
         assert "seed" in assembly_grp_name, "Need to specify a seed, `seed_average`, or `consensus`"
-        assembly_grp_dict, _ = utils.load_assemblies_from_h5(config.h5f_name, config.h5_prefix_assemblies)
-        return assembly_grp_dict[assembly_grp_name]
+        _, assembly_grp = next(utils.iter_assemblies_from_h5(config.h5f_name, config.h5_prefix_assemblies,
+                                                             seeds=[assembly_grp_name]))
+        return assembly_grp
 
 
 def _get_assembly_indegrees(assembly_grp, conn_mat, gids):
     """Gets indegrees from each assembly in the `assembly_grp` for all `gids`"""
-    assembly_indegrees = [conn_mat.degree(assembly.gids, gids) for assembly in assembly_grp.assemblies]
-    return np.vstack(assembly_indegrees).transpose()
+    return conn_mat.group_degrees([assembly.gids for assembly in assembly_grp.assemblies], gids)
 
 
 def run(config_path, assembly_grp_name, buf_size, seed):
@@ -331,9 +331,9 @@ def plot_db_scores(n, db_scores, fig_name):
 
 def _get_depth_yticks(loc_df):
     """Gets mean depth for each layer (used for setting ticks for depth based plots)"""
-    gb_locs = loc_df.groupby("layer")
-    yticks = gb_locs["depth"].mean().to_numpy()
-    yticklabels = ["L%s\n(%i)" % (l, n) for l, n in gb_locs.size().items()]
+    layer_depths = loc_df.groupby("layer")["depth"].agg(["mean", "size"])  # single pass over the groups
+    yticks = layer_depths["mean"].to_numpy()
+    yticklabels = ["L%s\n(%i)" % (l, n) for l, n in layer_depths["size"].items()]
     return yticks, yticklabels
 
 
@@ -346,22 +346,27 @@ def plot_assemblies(core_cell_idx, assembly_idx, gids, loc_df, fig_name):
     y_range = [loc_df["ss_flat_y"].min(), loc_df["ss_flat_y"].max()]
     extent = (x_range[0], x_range[1], y_range[0], y_range[1])
     depth_range = [loc_df["depth"].min(), loc_df["depth"].max()]
+    # look up the locations of all `gids` at once (instead of a pandas label lookup per assembly and column)
+    loc_idx = loc_df.index.get_indexer(gids)
+    assert (loc_idx >= 0).all(), "Some gids are missing from `loc_df`"
+    flat_xs, flat_ys = loc_df["ss_flat_x"].to_numpy()[loc_idx], loc_df["ss_flat_y"].to_numpy()[loc_idx]
+    depths = loc_df["depth"].to_numpy()[loc_idx]
 
     fig = plt.figure(figsize=(18, 10))
     n_rows = np.floor_divide(n, 5) + 1 if np.mod(n, 5) != 0 else int(n/5)
     gs = gridspec.GridSpec(2 * n_rows, 5)
     for i, assembly_id in enumerate(assembly_idx):
-        assembly_gids = gids[core_cell_idx[:, assembly_id] == 1]
+        assembly_mask = core_cell_idx[:, assembly_id] == 1
         ax = fig.add_subplot(gs[2 * np.floor_divide(i, 5), np.mod(i, 5)])
-        ax.hexbin(loc_df.loc[assembly_gids, "ss_flat_x"].to_numpy(), loc_df.loc[assembly_gids, "ss_flat_y"].to_numpy(),
+        ax.hexbin(flat_xs[assembly_mask], flat_ys[assembly_mask],
                   cmap=colors.LinearSegmentedColormap.from_list("assembly", [(1, 1, 1), cmap(i)], N=5),
                   gridsize=50, bins="log", extent=extent)
         ax.set_aspect("equal", "box")
-        ax.set_title("Assembly %i (n=%i)" % (assembly_id, len(assembly_gids)))
+        ax.set_title("Assembly %i (n=%i)" % (assembly_id, np.sum(assembly_mask)))
         ax.set_xticks([]); ax.set_yticks([])
         ax.set_xlim(x_range); ax.set_ylim(y_range)
         ax2 = fig.add_subplot(gs[2 * np.floor_divide(i, 5) + 1, np.mod(i, 5)])
-        ax2.hist(loc_df.loc[assembly_gids, "depth"].to_numpy(), bins=50, range=depth_range, orientation="horizontal",
+        ax2.hist(depths[assembly_mask], bins=50, range=depth_range, orientation="horizontal",
                  color=cmap(assembly_id), edgecolor=cmap(assembly_id))
         ax2.set_xticks([])
         ax2.set_yticks(yticks)
@@ -559,22 +564,22 @@ def plot_assembly_n_from(bin_centers, assembly_probs, assembly_probs_low, assemb
     plt.close(fig)
 
 
-def plot_frac_entropy_explained_by(mi_df, ylabel, fig_name):
+def plot_frac_entropy_explained_by(mi_matrix, row_labels, col_labels, ylabel, fig_name):
     """Plots matrix of entropy explained by innervation (by patterns or internal connections)"""
     fig = plt.figure(figsize=(10, 9))
     ax = fig.add_subplot(1, 1, 1)
-    if np.any(mi_df.to_numpy() < 0):  # relative case
-        abs_max = np.nanmax(mi_df.abs().to_numpy())
-        i = ax.imshow(mi_df, cmap="coolwarm", aspect="auto", interpolation="none", vmin=-1*abs_max, vmax=abs_max)
+    if np.any(mi_matrix < 0):  # relative case
+        abs_max = np.nanmax(np.abs(mi_matrix))
+        i = ax.imshow(mi_matrix, cmap="coolwarm", aspect="auto", interpolation="none", vmin=-1*abs_max, vmax=abs_max)
         fig.colorbar(i, label="Relative loss in entropy")
     else:  # 'classical' case
-        i = ax.imshow(mi_df, cmap="inferno", aspect="auto", interpolation="none")
+        i = ax.imshow(mi_matrix, cmap="inferno", aspect="auto", interpolation="none")
         fig.colorbar(i, label="Loss in entropy")
-    ax.set_xticks(np.arange(len(mi_df.columns)))
-    ax.set_xticklabels(mi_df.columns.to_numpy())
+    ax.set_xticks(np.arange(len(col_labels)))
+    ax.set_xticklabels(col_labels)
     ax.set_xlabel("Assembly")
-    ax.set_yticks(np.arange(len(mi_df.index)))
-    ax.set_yticklabels(mi_df.index.to_numpy())
+    ax.set_yticks(np.arange(len(row_labels)))
+    ax.set_yticklabels(row_labels)
     ax.set_ylabel(ylabel)
     fig.savefig(fig_name, dpi=100, bbox_inches="tight")
 
@@ -111,6 +111,19 @@ def convolve_spike_matrix(sim_config_path, node_pop, target, t_start, t_end, bin
     return np.vstack(convolved_spike_trains), gids
 
 
+def _spike_time_reliability(gid_trials_convolved):
+    """Mean pairwise cosine similarity of (mean centered) convolved spike trains of a single gid across trials"""
+    from assemblyfire.clustering import cosine_similarity
+
+    if gid_trials_convolved.shape[0] < 2:
+        return 0.
+    gid_trials_convolved -= np.mean(gid_trials_convolved, axis=1).reshape(-1, 1)  # mean center trials
+    sim_matrix = cosine_similarity(gid_trials_convolved)
+    # squareform implements its inverse if the input is a square matrix (but the diagonal has to be 0.)
+    np.fill_diagonal(sim_matrix, 0)  # stupid numpy...
+    return np.mean(squareform(sim_matrix))
+
+
 def spikes_to_h5(h5f_name, spike_matrix_dict, metadata, prefix):
     """Saves spike matrices to HDF5 file"""
     with h5py.File(h5f_name, "a") as h5f:
@@ -119,8 +132,13 @@ def spikes_to_h5(h5f_name, spike_matrix_dict, metadata, prefix):
             grp.attrs[k] = v
         for seed, SpikeMatrixResult in spike_matrix_dict.items():
             grp_out = grp.create_group("seed%s" % seed)
-            grp_out.create_dataset("spike_matrix", data=SpikeMatrixResult.spike_matrix, compression="gzip")
-            grp_out.create_dataset("gids", data=SpikeMatrixResult.gids)
+            spike_matrix = SpikeMatrixResult.spike_matrix
+            if spike_matrix.size and spike_matrix.min() >= 0 and not np.mod(spike_matrix, 1).any():
+                # (non-negative) spike counts are saved with the smallest unsigned int type instead of float64
+                # (casted back on load), anything else (e.g. negative values) is saved as it is
+                spike_matrix = spike_matrix.astype(np.min_scalar_type(int(spike_matrix.max())))
+            grp_out.create_dataset("spike_matrix", data=spike_matrix, compression="gzip", shuffle=True)
+            grp_out.create_dataset("gids", data=SpikeMatrixResult.gids, compression="gzip", shuffle=True)
             grp_out.create_dataset("t_bins", data=SpikeMatrixResult.t_bins)
 
 
@@ -128,7 +146,7 @@ def single_cell_features_to_h5(h5f_name, gids, r_spikes, prefix):
     """Saves single cell features to HDF5 file"""
     with h5py.File(h5f_name, "a") as h5f:
         grp = h5f.require_group(prefix)
-        grp.create_dataset("gids", data=gids)
+        grp.create_dataset("gids", data=gids, compression="gzip", shuffle=True)
         grp.create_dataset("r_spikes", data=r_spikes)
 
 
@@ -239,7 +257,6 @@ class SpikeMatrixGroup(Config):
     def get_spike_time_reliability(self):
         """Convolution based spike time reliability (`r_spike`) measure from Schreiber et al. 2003"""
         from assemblyfire.utils import get_sim_path
-        from assemblyfire.clustering import cosine_similarity
 
         # one can't simply np.dstack() them because it's not guaranteed that all gids spike in all trials
         gid_dict, convolved_spike_matrix_dict = {}, {}
@@ -253,20 +270,22 @@ class SpikeMatrixGroup(Config):
             del convolved_spike_matrix
             gc.collect()
         # build #gids matrices from trials and calculate pairwise correlation between rows
-        indiv_gids = []
-        for _, gids in gid_dict.items():
-            indiv_gids.extend(gids)
-        all_gids = np.unique(indiv_gids)
-        r_spikes = np.zeros_like(all_gids, dtype=np.float32)
-        for i, gid in enumerate(tqdm(all_gids, desc="Concatenating results for all gids", miniters=len(all_gids) / 100)):
-            # array of single neuron across trials with <=len(seed) rows
-            gid_trials_convolved = np.stack([convolved_spike_matrix_dict[seed][(gids == gid), :][0]
-                                             for seed, gids in gid_dict.items()
-                                             if len(convolved_spike_matrix_dict[seed][(gids == gid), :])])
-            if gid_trials_convolved.shape[0] > 1:
-                gid_trials_convolved -= np.mean(gid_trials_convolved, axis=1).reshape(-1, 1)  # mean center trials
-                sim_matrix = cosine_similarity(gid_trials_convolved)
-                # squareform implements its inverse if the input is a square matrix (but the diagonal has to be 0.)
-                np.fill_diagonal(sim_matrix, 0)  # stupid numpy...
-                r_spikes[i] = np.mean(squareform(sim_matrix))
-        return all_gids, r_spikes
+        all_gids = np.unique(np.concatenate(list(gid_dict.values())))
+        # map all gids to the rows of the (sorted by gid) convolved spike matrices at once (-1 if it didn't spike)
+        row_idx_dict = {}
+        for seed, gids in gid_dict.items():
+            row_idx = np.searchsorted(gids, all_gids)
+            row_idx[row_idx == len(gids)] = 0
+            row_idx[gids[row_idx] != all_gids] = -1
+            row_idx_dict[seed] = row_idx
+        if not len(all_gids):
+            return all_gids, np.array([], dtype=np.float32)
+        nprocs = max(1, min(len(all_gids), os.cpu_count() - 1))
+        with Parallel(n_jobs=nprocs, prefer="threads", batch_size=256) as p:
+            r_spikes = p(delayed(_spike_time_reliability)(
+                         # array of single neuron across trials with <=len(seed) rows
+                         np.stack([convolved_spike_matrix_dict[seed][row_idx[i], :]
+                                   for seed, row_idx in row_idx_dict.items() if row_idx[i] >= 0]))
+                         for i in tqdm(range(len(all_gids)), desc="Concatenating results for all gids",
+                                       miniters=len(all_gids) / 100))
+        return all_gids, np.array(r_spikes, dtype=np.float32)
@@ -4,6 +4,7 @@ authors: Daniela Egas Santander, Nicolas Ninin, András Ecker
 last modified: 01.2023
 """
 
+import os
 from tqdm import tqdm
 import numpy as np
 import pandas as pd
@@ -19,64 +20,197 @@ class AssemblyTopology(ConnectivityMatrix):
     of the subgraph associated to an assembly within the connectivity matrix of the circuit.
     """
 
+    def _idx(self, gids):
+        """Returns the row/column indices of `gids` in the matrix.
+        Same as `self._lookup[gids]` but with binary search in the (cached) sorted gids
+        instead of the pandas Series lookup (which is slow if called for every assembly)"""
+        if getattr(self, "_gids_argsort", None) is None:
+            self._gids_argsort = np.argsort(self.gids, kind="stable")
+            self._gids_sorted = self.gids[self._gids_argsort]
+        gids = np.asarray(self.__extract_vertex_ids__(gids))
+        pos = np.minimum(np.searchsorted(self._gids_sorted, gids), len(self._gids_sorted) - 1)
+        assert (self._gids_sorted[pos] == gids).all(), "Some gids are not in the connectivity matrix"
+        return self._gids_argsort[pos]
+
+    def _mask(self, gids):
+        """Returns a boolean mask over the rows/columns of the matrix, which is True for `gids`
+        (with binary search in (sorted) `gids`, gids that aren't in the matrix are ignored)"""
+        gids = np.sort(self.__extract_vertex_ids__(gids))
+        if not len(gids):
+            return np.zeros(len(self.gids), dtype=bool)
+        return gids[np.minimum(np.searchsorted(gids, self.gids), len(gids) - 1)] == self.gids
+
+    def _sparse_matrix(self, fmt="csc", edge_property=None):
+        """Returns the matrix (of `edge_property`) in sparse `fmt` format.
+        The conversions are cached, so that they aren't rebuilt from the edges' DataFrame for every assembly
+        (CSC is used for slicing columns and in degrees, CSR for slicing rows and out degrees)"""
+        edge_property = self._default_edge if edge_property is None else edge_property
+        cache = self.__dict__.setdefault("_sparse_matrix_cache", {})
+        if (fmt, edge_property) not in cache:
+            cache[(fmt, edge_property)] = self.matrix_(edge_property=edge_property).asformat(fmt)
+        return cache[(fmt, edge_property)]
+
+    def random_n_gids_groups(self, refs):
+        """Same as calling `ConnectivityMatrix.random_n_gids()` for all `refs`, but with a single random draw:
+        the gids with the smallest (sorted) values in each row of one (n_refs, n_gids) array of random keys are kept
+        (instead of drawing a permutation of all gids in `np.random.choice(replace=False)` for every reference)"""
+        sizes = np.array([len(ref) if hasattr(ref, "__len__") else ref for ref in refs], dtype=int)
+        if not len(sizes) or np.max(sizes) == 0:
+            return [np.array([], dtype=self.gids.dtype) for _ in sizes]
+        max_size = np.max(sizes)
+        keys = np.random.random((len(sizes), len(self.gids)))
+        idx = np.argpartition(keys, max_size - 1, axis=1)[:, :max_size]
+        idx = np.take_along_axis(idx, np.argsort(np.take_along_axis(keys, idx, axis=1), axis=1), axis=1)
+        return [self.gids[idx[i, :size]] for i, size in enumerate(sizes)]
+
+    def submatrix(self, sub_gids, edge_property=None, sub_gids_post=None):
+        """Returns a submatrix specified by `sub_gids` (and `sub_gids_post` if it's given)
+        Same as `ConnectivityMatrix.submatrix()` but with `self._idx()` above instead of `self._lookup`
+        and slicing rows (of the CSR matrix) and then columns (of the much smaller CSC matrix) separately,
+        instead of the (slow, for sparse matrices) `np.ix_()` based fancy indexing"""
+        idx = self._idx(sub_gids)
+        post_idx = idx if sub_gids_post is None else self._idx(sub_gids_post)
+        return self._sparse_matrix("csr", edge_property)[idx, :].tocsc()[:, post_idx]
+
     def degree(self, pre_gids=None, post_gids=None, kind="in"):
         """Returns in/out degrees of the (symmetric) subarray specified by `pre_gids`
-        (if `post_gids` is given as well, then the subarray will be asymmetric)"""
+        (if `post_gids` is given as well, then the subarray will be asymmetric).
+        Instead of slicing out the submatrix and summing it, the entries of the cached CSC (CSR for out degrees)
+        matrix are summed per column (row) with a single cumulative sum, masking the rows (columns) not in the subarray"""
+        if kind not in ["in", "out"]:
+            raise ValueError("Need to specify 'in' or 'out' degree!")
+        matrix = self._sparse_matrix("csc" if kind == "in" else "csr")
         if pre_gids is None:
-            matrix = self.matrix
-        else:
-            if post_gids is None:
-                matrix = self.submatrix(pre_gids)
-            else:
-                matrix = self.submatrix(pre_gids, sub_gids_post=post_gids)
+            return _compressed_sums(matrix)
+        post_gids = pre_gids if post_gids is None else post_gids
+        sum_gids, keep_gids = (post_gids, pre_gids) if kind == "in" else (pre_gids, post_gids)
+        keep = np.zeros(len(self.gids), dtype=bool)
+        keep[self._idx(keep_gids)] = True
+        return _compressed_sums(matrix, keep)[self._idx(sum_gids)]
+
+    def group_degrees(self, group_gids, gids=None, kind="in"):
+        """Returns in degrees of `gids` from (or out degrees to, if `kind` is 'out') each group of gids
+        in `group_gids` (e.g. a list of assembly gids) as a (len(gids), len(group_gids)) array.
+        Same as calling `degree()` above for all groups, but with a single sparse matrix multiplication
+        with an indicator matrix of the groups, instead of slicing submatrices one-by-one"""
+        from scipy.sparse import csr_matrix
+        gids = self.gids if gids is None else gids
+        group_idx = [self._idx(group) for group in group_gids]
+        rows = np.repeat(np.arange(len(group_idx)), [len(idx) for idx in group_idx])
+        indicator = csr_matrix((np.ones(len(rows), dtype=int), (rows, np.concatenate(group_idx))),
+                               shape=(len(group_idx), len(self.gids)))
         if kind == "in":
-            return np.array(matrix.sum(axis=0)).flatten()
+            degrees = indicator @ self._sparse_matrix("csc")
         elif kind == "out":
-            return np.array(matrix.sum(axis=1)).flatten()
+            degrees = indicator @ self._sparse_matrix("csr").transpose()
         else:
-            ValueError("Need to specify 'in' or 'out' degree!")
+            raise ValueError("Need to specify 'in' or 'out' degree!")
+        return degrees[:, self._idx(gids)].toarray().transpose()
 
     def density(self, sub_gids=None):
-        """Returns the density of submatrix specified by `sub_gids`"""
-        matrix = self.matrix if sub_gids is None else self.submatrix(sub_gids)
-        return matrix.getnnz()/np.prod(matrix.shape)
+        """Returns the density of submatrix specified by `sub_gids`
+        (the nr. of edges is counted from the `indptr` and `indices` of the cached CSR matrix, without slicing it)"""
+        matrix = self._sparse_matrix("csr")
+        if sub_gids is None:
+            return matrix.indptr[-1] / np.prod(matrix.shape)
+        idx = self._idx(sub_gids)
+        keep = np.zeros(len(self.gids), dtype=bool)
+        keep[idx] = True
+        n_edges = np.concatenate([[0], np.cumsum(keep[matrix.indices])])
+        return np.sum(n_edges[matrix.indptr[idx + 1]] - n_edges[matrix.indptr[idx]]) / len(idx) ** 2
 
     def simplex_counts(self, sub_gids=None):
         """Returns the simplex counts of submatrix specified by `sub_gids`"""
         from pyflagser import flagser_count_unweighted
-        matrix = self.matrix if sub_gids is None else self.submatrix(sub_gids)
+        matrix = self._sparse_matrix("csr") if sub_gids is None else self.submatrix(sub_gids)
         return flagser_count_unweighted(matrix, directed=True)
 
+    def simplex_counts_groups(self, group_gids):
+        """Same as calling `simplex_counts()` above for all groups of gids in `group_gids` (e.g. assemblies and their
+        controls), but with the submatrices built in the main process and the (independent and CPU bound)
+        flagser calls run in parallel processes"""
+        if not len(group_gids):
+            return []
+        from joblib import Parallel, delayed
+        from pyflagser import flagser_count_unweighted
+        nprocs = max(1, min(len(group_gids), os.cpu_count() - 1))
+        with Parallel(n_jobs=nprocs, prefer="processes") as p:
+            return p(delayed(flagser_count_unweighted)(self.submatrix(gids), directed=True) for gids in group_gids)
+
     def simplex_list(self, pre_gids=None, post_gids=None):
         """Returns the simplex list of submatrix specified by `sub_gids`"""
-        from scipy.sparse import coo_matrix
+        from scipy.sparse import csr_matrix
         from pyflagsercount import flagser_count
         if pre_gids is None:
-            matrix = self.matrix
+            matrix = self._sparse_matrix("csr")
         else:
             if post_gids is None:
                 matrix = self.submatrix(pre_gids)
             else:
-                row_gids = self.gids[self._edge_indices["row"].to_numpy()]
-                if (post_gids == self.gids).all():
-                    keep_idx = np.in1d(row_gids, pre_gids)
-                else:
-                    col_gids = self.gids[self._edge_indices["col"].to_numpy()]
-                    keep_idx = np.in1d(row_gids, pre_gids) & np.in1d(col_gids, post_gids)
-                matrix = coo_matrix((self.edges["data"][keep_idx].to_numpy(),
-                                     (self._edge_indices["row"][keep_idx].to_numpy(),
-                                      self._edge_indices["col"][keep_idx].to_numpy())),
-                                    shape=(len(self.gids), len(self.gids)))
+                # keep the full matrix (so vertex IDs don't change) but zero out the rows not in `pre_gids`
+                # (and the columns not in `post_gids`) by multiplying with diagonal selection matrices
+                n = len(self.gids)
+                row_idx = np.nonzero(self._mask(pre_gids))[0]
+                select_rows = csr_matrix((np.ones(len(row_idx), dtype=bool), (row_idx, row_idx)), shape=(n, n))
+                matrix = select_rows @ self._sparse_matrix("csr")
+                if not np.array_equal(post_gids, self.gids):
+                    col_idx = np.nonzero(self._mask(post_gids))[0]
+                    matrix = matrix @ csr_matrix((np.ones(len(col_idx), dtype=bool), (col_idx, col_idx)),
+                                                 shape=(n, n))
         flagser = flagser_count(matrix, return_simplices=True, max_simplices=False)
         return [np.array(x) for x in flagser["simplices"]]
 
     def betti_counts(self, sub_gids=None):
         """Returns the betti counts of submatrix specified by `sub_gids`"""
         from pyflagser import flagser_unweighted
-        matrix = self.matrix if sub_gids is None else self.submatrix(sub_gids)
+        matrix = self._sparse_matrix("csr") if sub_gids is None else self.submatrix(sub_gids)
         return flagser_unweighted(matrix, directed=True)["betti"]
 
 
+def _compressed_sums(matrix, mask=None):
+    """Sums the stored entries of a CSC (CSR) `matrix` per column (row) - only the ones in rows (columns)
+    where `mask` is True if it's given - with a cumulative sum over `matrix.data` and `matrix.indptr` arithmetic"""
+    data = matrix.data if mask is None else np.where(mask[matrix.indices], matrix.data, 0)
+    sums = np.concatenate([[0], np.cumsum(data)])
+    return sums[matrix.indptr[1:]] - sums[matrix.indptr[:-1]]
+
+
+def _control_builders(conn_mat):
+    """Returns functions that draw random controls of the same size/depth profile/mtype composition for a list of
+    assembly gids (the depth and mtype properties are indexed only once, and not for every assembly)"""
+    depth_idx, mtype_idx = conn_mat.index("depth"), conn_mat.index("mtype")
+    return {"n": conn_mat.random_n_gids_groups,
+            "depths": lambda group_gids: [depth_idx.random_numerical_gids(gids) for gids in group_gids],
+            "mtypes": lambda group_gids: [mtype_idx.random_categorical_gids(gids) for gids in group_gids]}
+
+
+def _assembly_and_control_gids(assembly_grp, control_builders):
+    """Returns assembly labels and a flat list of the gids of all assemblies followed by the ones of all their controls
+    (in the order of `control_builders`), so that metrics can be computed for all of them in one batch"""
+    keys = [assembly.idx for assembly in assembly_grp.assemblies]
+    assembly_gids = [assembly.gids for assembly in assembly_grp.assemblies]
+    return keys, assembly_gids + [gids for build in control_builders.values() for gids in build(assembly_gids)]
+
+
+def _split_controls(keys, results, control_builders):
+    """Splits batched `results` (see `_assembly_and_control_gids()` above) into a dict with assembly labels as keys
+    and another dict with control names as keys, and similar dicts as values"""
+    n = len(keys)
+    return dict(zip(keys, results[:n])), {control: dict(zip(keys, results[(i + 1) * n:(i + 2) * n]))
+                                          for i, control in enumerate(control_builders)}
+
+
+def _group_in_degrees(conn_mat, group_gids, post_gids=None):
+    """Same as `[conn_mat.degree(gids, post_gids, kind="in") for gids in group_gids]`, i.e., in degrees
+    within each group (or from each group to `post_gids` if it's specified) but with a single `group_degrees()` call"""
+    if post_gids is not None:
+        degrees = conn_mat.group_degrees(group_gids, post_gids)
+        return [degrees[:, i] for i in range(len(group_gids))]
+    all_gids = np.unique(np.concatenate(group_gids))
+    degrees = conn_mat.group_degrees(group_gids, all_gids)
+    return [degrees[np.searchsorted(all_gids, gids), i] for i, gids in enumerate(group_gids)]
+
+
 def in_degree_assemblies(assembly_grp_dict, conn_mat, post_id=None):
     """
     Computes the in degree distribution within assemblies (or cross-assemblies if `post_assembly_id` is specified)
@@ -90,20 +224,14 @@ def in_degree_assemblies(assembly_grp_dict, conn_mat, post_id=None):
                           with keys ['n', 'depths', 'mtype'] and yet another dict similar to `in_degrees`
                           but values are in degrees of the random controls
     """
-    in_degrees = {}
-    in_d_control = {seed: {} for seed in list(assembly_grp_dict.keys())}
+    in_degrees, in_d_control = {}, {}
+    control_builders = _control_builders(conn_mat)
     for seed, assembly_grp in tqdm(assembly_grp_dict.items(), desc="Getting in-degrees"):
         post_gids = assembly_grp.loc((post_id, int(seed.split("seed")[1]))).gids if post_id is not None else None
-        in_degrees[seed] = {assembly.idx: conn_mat.degree(assembly.gids, post_gids, kind="in")
-                            for assembly in assembly_grp.assemblies}
-        in_d_control[seed]["n"] = {assembly.idx: conn_mat.degree(conn_mat.random_n_gids(assembly.gids), post_gids,
-                                   kind="in") for assembly in assembly_grp.assemblies}
-        in_d_control[seed]["depths"] = {assembly.idx: conn_mat.degree(
-                                        conn_mat.index("depth").random_numerical_gids(assembly.gids), post_gids,
-                                        kind="in") for assembly in assembly_grp.assemblies}
-        in_d_control[seed]["mtypes"] = {assembly.idx: conn_mat.degree(
-                                        conn_mat.index("mtype").random_categorical_gids(assembly.gids), post_gids,
-                                        kind="in") for assembly in assembly_grp.assemblies}
+        # draw all random controls first, and get all in degrees with a single sparse matrix multiplication
+        keys, group_gids = _assembly_and_control_gids(assembly_grp, control_builders)
+        group_in_degrees = _group_in_degrees(conn_mat, group_gids, post_gids)
+        in_degrees[seed], in_d_control[seed] = _split_controls(keys, group_in_degrees, control_builders)
     return in_degrees, in_d_control
 
 
@@ -119,57 +247,86 @@ def simplex_counts_assemblies(assembly_grp_dict, conn_mat):
                                     with keys ['n', 'depths', 'mtype'] and yet another dict similar to `simplex_count`
                                     but values are simplex counts of the random controls
     """
-    simplex_counts = {}
-    s_c_control = {seed: {} for seed in list(assembly_grp_dict.keys())}
+    simplex_counts, s_c_control = {}, {}
+    control_builders = _control_builders(conn_mat)
     for seed, assembly_grp in tqdm(assembly_grp_dict.items(), desc="Counting simplices"):
-        simplex_counts[seed] = {assembly.idx: conn_mat.simplex_counts(assembly.gids)
-                                for assembly in assembly_grp.assemblies}
-        s_c_control[seed]["n"] = {assembly.idx: conn_mat.simplex_counts(conn_mat.random_n_gids(assembly.gids))
-                                  for assembly in assembly_grp.assemblies}
-        s_c_control[seed]["depths"] = {assembly.idx: conn_mat.simplex_counts(
-                                       conn_mat.index("depth").random_numerical_gids(assembly.gids))
-                                       for assembly in assembly_grp.assemblies}
-        s_c_control[seed]["mtypes"] = {assembly.idx: conn_mat.simplex_counts(
-                                       conn_mat.index("mtype").random_categorical_gids(assembly.gids))
-                                       for assembly in assembly_grp.assemblies}
+        keys, group_gids = _assembly_and_control_gids(assembly_grp, control_builders)
+        group_simplex_counts = conn_mat.simplex_counts_groups(group_gids)
+        simplex_counts[seed], s_c_control[seed] = _split_controls(keys, group_simplex_counts, control_builders)
     return simplex_counts, s_c_control
 
 
 def simplex_counts_consensus_instantiations(assembly_grp, conn_mat):
     """Computes the simplices of all assemblies making up the consensus assemblies
     and a random control of the size of the average of instantiations"""
-    simplex_count, s_c_control = {}, {}
-    for assembly in tqdm(assembly_grp.assemblies, desc="Counting simplices"):
-        simplex_count[assembly.idx[0]] = [conn_mat.simplex_counts(inst.gids) for inst in assembly.instantiations]
-        ctrl_gids = conn_mat.random_n_gids(int(np.mean([len(inst.gids) for inst in assembly.instantiations])))
-        s_c_control[assembly.idx[0]] = [conn_mat.simplex_counts(ctrl_gids)]
+    # all random controls are drawn at once, and the simplices of all instantiations and controls
+    # are counted in one (parallel) batch
+    all_ctrl_gids = conn_mat.random_n_gids_groups([int(np.mean([len(inst.gids) for inst in assembly.instantiations]))
+                                                   for assembly in assembly_grp.assemblies])
+    group_gids = [inst.gids for assembly in assembly_grp.assemblies for inst in assembly.instantiations]
+    n_insts = np.cumsum([0] + [len(assembly.instantiations) for assembly in assembly_grp.assemblies])
+    group_simplex_counts = conn_mat.simplex_counts_groups(group_gids + all_ctrl_gids)
+    keys = [assembly.idx[0] for assembly in assembly_grp.assemblies]
+    simplex_count = {key: group_simplex_counts[n_insts[i]:n_insts[i + 1]] for i, key in enumerate(keys)}
+    s_c_control = {key: [group_simplex_counts[n_insts[-1] + i]] for i, key in enumerate(keys)}
     return simplex_count, s_c_control
 
 
-def bin_gids_by_innervation(all_indegrees, gids, n_bins, incl_extrema=False):
-    """Creates lookups of gids in optimal bins for each pre-synaptic group (in terms of in-degree)
-    works with both dictionary and DataFrame (column-wise)"""
-    binned_gids, bin_centers_dict, bin_idx_dict = {key: {} for key in list(all_indegrees.keys())}, {}, {}
-    for key, indegrees in all_indegrees.items():
-        if isinstance(indegrees, pd.Series):
-            indegrees = indegrees.to_numpy()
-        if np.any(indegrees < 0):  # to deal with zsored values...
-            idx = ~np.isnan(indegrees)
-            bin_edges = np.linspace(np.percentile(indegrees[idx], 1), np.percentile(indegrees[idx], 99), n_bins + 1)
-            indegrees[~idx] = np.min(indegrees)  # replace NaNs with minimum value (to not break stuff afterwards)
-        else:
-            bin_edges = np.hstack(([0], np.linspace(np.percentile(indegrees[indegrees != 0], 1),
-                                                    np.percentile(indegrees[indegrees != 0], 99), n_bins)))
-        bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
-        bin_centers_dict[key] = bin_centers
-        bin_idx = np.digitize(indegrees, bin_edges, right=True)
-        bin_idx_dict[key] = bin_idx
-        for i, center in enumerate(bin_centers):
-            binned_gids[key][center] = gids[bin_idx == i+1]
-        if incl_extrema:
-            binned_gids[key][center] = np.concatenate(binned_gids[key][center], gids[bin_idx == i + 2])
-            binned_gids[key][bin_centers[0]] = np.concatenate(binned_gids[key][bin_centers[0]], gids[bin_idx == 0])
-    return binned_gids, bin_centers_dict, bin_idx_dict
+def bin_gids_by_innervation(all_indegrees, gids, n_bins):
+    """Bins gids (for each pre-synaptic group) in optimal bins in terms of in-degree
+    works with both dictionary and DataFrame (column-wise). Bin edges (percentiles) are calculated
+    for all groups at once (on a (n_gids, n_groups) array), and then the gids are binned with a binary search
+    (`np.searchsorted(side="left")` is the same as `np.digitize(right=True)`).
+    :return bin_centers_dict: dict with bin centers for each group
+    :return bin_idx_dict: dict with bin indices (from 1 to `n_bins`, 0 and `n_bins` + 1 are outliers) for each group
+    """
+    keys = list(all_indegrees.keys())
+    indegrees = np.column_stack([np.asarray(all_indegrees[key], dtype=np.float64) for key in keys])
+    assert indegrees.shape[0] == len(gids), "Innervation should be passed for all gids"
+    bin_edges = np.zeros((n_bins + 1, len(keys)), dtype=np.float64)
+    zscored = np.nanmin(indegrees, axis=0) < 0  # to deal with zsored values...
+    if np.any(zscored):  # NaNs are ignored (and will be binned beyond the last bin edge)
+        percentiles = np.nanpercentile(indegrees[:, zscored], [1, 99], axis=0)
+        bin_edges[:, zscored] = np.linspace(percentiles[0], percentiles[1], n_bins + 1)
+    if np.any(~zscored):  # ignore 0 in-degrees when calculating the percentiles (first bin edge is set to 0)
+        nonzero_indegrees = indegrees[:, ~zscored].copy()
+        nonzero_indegrees[nonzero_indegrees == 0] = np.nan
+        percentiles = np.nanpercentile(nonzero_indegrees, [1, 99], axis=0)
+        bin_edges[1:, ~zscored] = np.linspace(percentiles[0], percentiles[1], n_bins)
+    bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
+    bin_centers_dict, bin_idx_dict = {}, {}
+    for i, key in enumerate(keys):
+        bin_centers_dict[key] = bin_centers[:, i]
+        bin_idx_dict[key] = np.searchsorted(bin_edges[:, i], indegrees[:, i], side="left")
+    return bin_centers_dict, bin_idx_dict
+
+
+def _build_gid_mask(assembly_gids, max_gid):
+    """Builds boolean mask (indexable with gids) of assembly membership, which makes lookups O(1)
+    (instead of sorting `gids` again and again in `np.in1d()` in the nested loops below)"""
+    mask = np.zeros(np.max([max_gid, np.max(assembly_gids)]) + 1, dtype=bool)
+    mask[assembly_gids] = True
+    return mask
+
+
+def _chance_levels(gids, assembly_gids_list):
+    """Fraction of `gids` that are members of each assembly (with gids passed in `assembly_gids_list`) at once:
+    counts the assembly gids that are in `gids` (instead of building a membership mask over `gids` per assembly)"""
+    non_empty = [i for i, assembly_gids in enumerate(assembly_gids_list) if len(assembly_gids)]
+    if not len(non_empty):  # (empty assemblies have 0 members in `gids`)
+        return np.zeros(len(assembly_gids_list))
+    max_gid = np.max([np.max(assembly_gids_list[i]) for i in non_empty])
+    in_gids = _build_gid_mask(gids, max_gid)[np.concatenate([assembly_gids_list[i] for i in non_empty])]
+    assembly_idx = np.repeat(non_empty, [len(assembly_gids_list[i]) for i in non_empty])
+    return np.bincount(assembly_idx, weights=in_gids, minlength=len(assembly_gids_list)) / len(gids)
+
+
+def _binom_ci(n_hits, n_samples):
+    """Binomial distribution based confidence interval of `n_hits` out of `n_samples`"""
+    p = np.linspace(0, 1, 100)
+    p_n_cond_p = binom(n_samples, p).pmf(n_hits)
+    p_p_post = np.cumsum(p_n_cond_p / np.sum(p_n_cond_p))
+    return np.interp(0.05, p_p_post, p), np.interp(0.95, p_p_post, p)
 
 
 def prob_with_binom_ci(samples, min_n):
@@ -178,28 +335,41 @@ def prob_with_binom_ci(samples, min_n):
     n_samples = len(samples)
     if n_samples < min_n:
         return np.nan, np.nan, np.nan
-    p = np.linspace(0, 1, 100)
-    p_n_cond_p = binom(n_samples, p).pmf(np.sum(samples))
-    p_p_post = p_n_cond_p / np.sum(p_n_cond_p)
-    return np.mean(samples), np.interp(0.05, np.cumsum(p_p_post), p), np.interp(0.95, np.cumsum(p_p_post), p)
+    return (np.mean(samples), *_binom_ci(np.sum(samples), n_samples))
+
+
+def _probs_with_binom_ci(hits, counts, min_n):
+    """Probabilities and binomial distribution based confidence intervals from (arrays of) hit and sample counts"""
+    probs = np.full(counts.shape, np.nan, dtype=np.float32)
+    probs_low, probs_high = np.full_like(probs, np.nan), np.full_like(probs, np.nan)
+    for i in zip(*np.nonzero(counts >= min_n)):
+        probs[i] = hits[i] / counts[i]
+        probs_low[i], probs_high[i] = _binom_ci(hits[i], counts[i])
+    return probs, probs_low, probs_high
 
 
-def assembly_membership_probability(gids, assembly_grp, binned_gids, bin_centers, bin_min_n):
+def binned_prob_with_binom_ci(samples, bin_idx, n_bins, min_n):
+    """Vectorized version of `prob_with_binom_ci()` above for all bins (defined by `bin_idx` from `np.digitize`)
+    at once: sample and hit counts in the bins are got with one `np.bincount()` call each"""
+    counts = np.bincount(bin_idx, minlength=n_bins + 1)[1:n_bins + 1]
+    hits = np.bincount(bin_idx, weights=samples.astype(bool), minlength=n_bins + 1)[1:n_bins + 1]
+    return _probs_with_binom_ci(hits, counts, min_n)
+
+
+def assembly_membership_probability(gids, assembly_grp, bin_centers, bin_idx, bin_min_n):
     """Gets membership probability (and CI) for all gids in all assemblies (using pre-binned indegrees)"""
-    chance_levels = {}
-    keys = list(binned_gids.keys())
+    keys = list(bin_idx.keys())
     bin_centers_plot, assembly_probs = {key: {} for key in keys}, {key: {} for key in keys}
     assembly_probs_low, assembly_probs_high = {key: {} for key in keys}, {key: {} for key in keys}
+    max_gid = np.max(gids)
+    chance_levels = dict(zip([assembly.idx[0] for assembly in assembly_grp.assemblies],
+                             _chance_levels(gids, [assembly.gids for assembly in assembly_grp.assemblies])))
     for assembly in assembly_grp.assemblies:
         assembly_id = assembly.idx[0]
-        chance_levels[assembly_id] = np.mean(np.in1d(gids, assembly.gids, assume_unique=True))
-        for key, binned_gids_tmp in binned_gids.items():
+        idx = _build_gid_mask(assembly.gids, max_gid)[gids]
+        for key, bin_idx_ in bin_idx.items():
             bin_centers_plot[key][assembly_id] = bin_centers[key]
-            probs = np.zeros_like(bin_centers[key], dtype=np.float32)
-            probs_low, probs_high = np.zeros_like(probs), np.zeros_like(probs)
-            for i, bin_center in enumerate(bin_centers[key]):
-                idx = np.in1d(binned_gids_tmp[bin_center], assembly.gids, assume_unique=True)
-                probs[i], probs_low[i], probs_high[i] = prob_with_binom_ci(idx, bin_min_n)
+            probs, probs_low, probs_high = binned_prob_with_binom_ci(idx, bin_idx_, len(bin_centers[key]), bin_min_n)
             assembly_probs[key][assembly_id] = probs
             assembly_probs_low[key][assembly_id] = probs_low
             assembly_probs_high[key][assembly_id] = probs_high
@@ -209,58 +379,97 @@ def assembly_membership_probability(gids, assembly_grp, binned_gids, bin_centers
 def cond_assembly_membership_probability(gids, assembly_grp, bin_centers, bin_idx, cond_df, cond_keys, seed, bin_min_n):
     """Reimplementation of `assembly_membership_probability()` above with some changes:
     1: it's not using pre-binned gids, but `bin_idx` (from `np.digitize`) and an extra condition passed in `cond_df`
+       (either a DataFrame or a dict of arrays with assembly IDs as keys)
     2: it doesn't do full cross assembly analysis (because that's a lot with extra condition), only within assembly."""
     if isinstance(seed, str) and seed not in ["consensus", "average"]:
         seed = int(seed.split("seed")[1])
-    chance_levels = {}
     keys = list(cond_keys.keys())
     bin_centers_plot, assembly_probs = {key: {} for key in keys}, {key: {} for key in keys}
     assembly_probs_low, assembly_probs_high = {key: {} for key in keys}, {key: {} for key in keys}
+    max_gid = np.max(gids)
+    assembly_idx = list(bin_centers.keys())
+    chance_levels = dict(zip(assembly_idx, _chance_levels(gids, [assembly_grp.loc((assembly_id, seed)).gids
+                                                                for assembly_id in assembly_idx])))
     for assembly_id, bin_centers_ in bin_centers.items():
-        assembly_gids = assembly_grp.loc((assembly_id, seed)).gids
-        chance_levels[assembly_id] = np.mean(np.in1d(gids, assembly_gids, assume_unique=True))
-        for key, key_id in cond_keys.items():
+        idx = _build_gid_mask(assembly_grp.loc((assembly_id, seed)).gids, max_gid)[gids]
+        # composite (condition, bin) index to get sample and hit counts for all conditions and bins in one go
+        n_bins = len(bin_centers_)
+        cond_idx = np.full(len(gids), -1, dtype=int)
+        cond = np.asarray(cond_df[assembly_id])
+        for i, key_id in enumerate(cond_keys.values()):
+            cond_idx[cond == key_id] = i
+        valid = cond_idx >= 0
+        composite_idx = cond_idx[valid] * (n_bins + 2) + bin_idx[assembly_id][valid]
+        counts = np.bincount(composite_idx, minlength=len(keys) * (n_bins + 2)).reshape(len(keys), n_bins + 2)
+        hits = np.bincount(composite_idx, weights=idx[valid], minlength=len(keys) * (n_bins + 2)).reshape(counts.shape)
+        probs, probs_low, probs_high = _probs_with_binom_ci(hits[:, 1:n_bins + 1], counts[:, 1:n_bins + 1], bin_min_n)
+        for i, key in enumerate(keys):
             bin_centers_plot[key][assembly_id] = bin_centers_
-            probs = np.zeros_like(bin_centers_, dtype=np.float32)
-            probs_low, probs_high = np.zeros_like(probs), np.zeros_like(probs)
-            for i in range(len(bin_centers_)):
-                gids_tmp = gids[np.logical_and((bin_idx[assembly_id] == i + 1),
-                                               (cond_df[assembly_id] == key_id).to_numpy())]
-                idx = np.in1d(gids_tmp, assembly_gids, assume_unique=True)
-                probs[i], probs_low[i], probs_high[i] = prob_with_binom_ci(idx, bin_min_n)
-            assembly_probs[key][assembly_id] = probs
-            assembly_probs_low[key][assembly_id] = probs_low
-            assembly_probs_high[key][assembly_id] = probs_high
+            assembly_probs[key][assembly_id] = probs[i]
+            assembly_probs_low[key][assembly_id] = probs_low[i]
+            assembly_probs_high[key][assembly_id] = probs_high[i]
     return bin_centers_plot, assembly_probs, assembly_probs_low, assembly_probs_high, chance_levels
 
 
+def _binary_entropy(p):
+    """Entropy (in bits) of Bernoulli variable(s) with probability `p` (0 * log(0) is taken as 0)"""
+    p = np.clip(p, 0., 1.)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        h = -p * np.log2(p) - (1 - p) * np.log2(1 - p)
+    return np.nan_to_num(h, nan=0.)
+
+
+def _binned_entropy_mi(idx, counts, hits):
+    """Entropy of (boolean) assembly membership `idx` and its mutual information with the binned innervation
+    from the number of gids (`counts`) and assembly members (`hits`) in all bins (got by `np.bincount()`).
+    Gives the same values as `drv.entropy(idx)` and `drv.information_mutual(idx, bin_idx)`,
+    but without `drv`'s joint histogram and temporary arrays (as idx is binary, H(X|Y) is a weighted sum)"""
+    n = len(idx)
+    valid = counts > 0
+    h = _binary_entropy(np.sum(hits) / n)
+    h_cond = np.sum(counts[valid] * _binary_entropy(hits[valid] / counts[valid])) / n
+    return h, h - h_cond
+
+
 def _sign(bin_centers, probs, counts=None):
-    """Gets sign of line fitted to assembly probs. vs. indegree"""
-    return np.sign(np.polyfit(bin_centers, probs, 1, w=counts)[0])
+    """Gets sign of line fitted to assembly probs. vs. indegree
+    (The sign of the (weighted) least-squares slope is the sign of the weighted covariance, so there is no need
+    for `np.polyfit()`. As `np.polyfit()` weights the residuals (not their squares), the weights are `counts**2`)"""
+    w = np.ones_like(bin_centers, dtype=np.float64) if counts is None else np.asarray(counts, dtype=np.float64) ** 2
+    x_mean, y_mean = np.average(bin_centers, weights=w), np.average(probs, weights=w)
+    return np.sign(np.sum(w * (bin_centers - x_mean) * (probs - y_mean)))
 
 
-def assembly_rel_frac_entropy_explained(gids, assembly_grp, bin_centers, bin_idx, seed, bin_min_n, sign_th):
+def assembly_rel_frac_entropy_explained(gids, assembly_grp, bin_centers, bin_idx, seed, bin_min_n, sign_th, rng=None):
     """Gets mutual information between assembly membership and structural innervation (using pre-binned indegrees)
-    and gives it a sign (hence 'relative') based on fitting the probabilities with a line"""
+    and gives it a sign (hence 'relative') based on fitting the probabilities with a line
+    (the shuffled controls are drawn from `rng` if it's passed, and from the global `np.random` state otherwise)
+    Returns the (len(keys), len(assembly_idx)) MI matrix together with its row and column labels"""
+    permutation = np.random.permutation if rng is None else rng.permutation
     if isinstance(seed, str) and seed not in ["consensus", "average"]:
         seed = int(seed.split("seed")[1])
     keys = np.sort(list(bin_idx.keys()))
     assembly_idx = np.sort([assembly.idx[0] for assembly in assembly_grp.assemblies])
     mi_matrix = np.zeros((len(keys), len(assembly_idx)), dtype=np.float32)
     mi_ctrl_matrix = np.zeros_like(mi_matrix)
+    max_gid = np.max(gids)
     for j, assembly_id in enumerate(assembly_idx):
+        idx = _build_gid_mask(assembly_grp.loc((assembly_id, seed)).gids, max_gid)[gids]
         for i, key in enumerate(keys):
-            idx = np.in1d(gids, assembly_grp.loc((assembly_id, seed)).gids, assume_unique=True)
-            bin_idx_ = bin_idx[key].copy()
-            mi = drv.information_mutual(idx, bin_idx_) / drv.entropy(idx)
-            mi_ctrl = drv.information_mutual(idx, np.random.permutation(bin_idx_)) / drv.entropy(idx)
+            bin_idx_ = bin_idx[key]
+            n_bins = len(bin_centers[key])
+            all_counts = np.bincount(bin_idx_, minlength=n_bins + 1)
+            all_hits = np.bincount(bin_idx_, weights=idx, minlength=n_bins + 1)
+            h, mi = _binned_entropy_mi(idx, all_counts, all_hits)
+            mi /= h
+            _, mi_ctrl = _binned_entropy_mi(idx, all_counts, np.bincount(permutation(bin_idx_),
+                                                                         weights=idx, minlength=n_bins + 1))
+            mi_ctrl /= h
             # recalculate assembly probability for line fitting
             # (could be passed from `get_assembly_membership_probability()` but whatever...)
-            probs = np.zeros_like(bin_centers[key], dtype=np.float32)
-            counts = np.zeros_like(probs, dtype=int)
-            for k in range(len(bin_centers[key])):
-                tmp = idx[bin_idx_ == k + 1]
-                counts[k], probs[k] = len(tmp), np.mean(tmp)
+            counts = all_counts[1:n_bins + 1]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                probs = (all_hits[1:n_bins + 1] / counts).astype(np.float32)
             valid_n_idx = np.where(counts >= bin_min_n)[0]
             if len(valid_n_idx):
                 mi_sign = _sign(bin_centers[key][valid_n_idx], probs[valid_n_idx], counts[valid_n_idx])
@@ -273,21 +482,23 @@ def assembly_rel_frac_entropy_explained(gids, assembly_grp, bin_centers, bin_idx
         mi_matrix[np.abs(mi_matrix) < (np.nanmean(mi_ctrl_matrix) + sign_th * np.nanstd(mi_ctrl_matrix))] = np.nan
     ratio = (np.nanmean(np.abs(mi_matrix)) - np.nanmean(mi_ctrl_matrix)) / np.nanstd(mi_ctrl_matrix)
     print("MI ratio (between data and shuffled/control data): %.2f" % ratio)
-    return pd.DataFrame(data=mi_matrix, columns=assembly_idx, index=keys)
+    return mi_matrix, keys, assembly_idx
 
 
 def assembly_cond_frac_entropy_explained(gids, assembly_grp, bin_idx, bin_idx_cond, seed, sign_th):
     """Gets conditional mutual information between assembly membership and structural innervation
-    (using pre-binned indegrees). (Unlike above here it would be hard to define the sign, so we just skip it...)"""
+    (using pre-binned indegrees). (Unlike above here it would be hard to define the sign, so we just skip it...)
+    Returns the (len(keys), len(assembly_idx)) MI matrix together with its row and column labels"""
     if isinstance(seed, str) and seed not in ["consensus", "average"]:
         seed = int(seed.split("seed")[1])
     keys = np.sort(list(bin_idx.keys()))
     assembly_idx = np.sort([assembly.idx[0] for assembly in assembly_grp.assemblies])
     mi_matrix = np.zeros((len(keys), len(assembly_idx)), dtype=np.float32)
     mi_ctrl_matrix = np.zeros_like(mi_matrix)
+    max_gid = np.max(gids)
     for j, assembly_id in enumerate(assembly_idx):
+        idx = _build_gid_mask(assembly_grp.loc((assembly_id, seed)).gids, max_gid)[gids]
         for i, key in enumerate(keys):
-            idx = np.in1d(gids, assembly_grp.loc((assembly_id, seed)).gids, assume_unique=True)
             bin_idx_ = bin_idx[key].copy()
             bin_idx_cond_ = bin_idx_cond[key]
             mi_matrix[i, j] = drv.information_mutual_conditional(idx, bin_idx_, bin_idx_cond_)\
@@ -299,5 +510,5 @@ def assembly_cond_frac_entropy_explained(gids, assembly_grp, bin_idx, bin_idx_co
         mi_matrix[mi_matrix < (np.mean(mi_ctrl_matrix) + sign_th * np.std(mi_ctrl_matrix))] = np.nan
     ratio = (np.nanmean(mi_matrix) - np.mean(mi_ctrl_matrix)) / np.std(mi_ctrl_matrix)
     print("Conditional MI ratio (between data and shuffled/control data): %.2f" % ratio)
-    return pd.DataFrame(data=mi_matrix, columns=assembly_idx, index=keys)
+    return mi_matrix, keys, assembly_idx
 
@@ -7,23 +7,38 @@ import os
 import json
 import h5py
 import warnings
+from functools import lru_cache
 from collections import namedtuple
 import numpy as np
 import pandas as pd
 from libsonata import EdgeStorage
 from bluepysnap import Circuit, Simulation
 
+# spike matrices loaded from h5 are always float64 (see `load_spikes_from_h5()` below)
 SpikeMatrixResult = namedtuple("SpikeMatrixResult", ["spike_matrix", "gids", "t_bins"])
 
 
-def get_bluepy_circuit(circuitconfig_path):
+# circuits, simulations and simulation paths are cached (keyed on absolute paths) as several analysis
+# entry points load the same ones within a run (and each load means disk I/O and config parsing).
+# The same Circuit/Simulation objects are returned to all callers, so they should be treated as read-only
+@lru_cache(maxsize=8)
+def _get_bluepy_circuit(circuitconfig_path):
     return Circuit(circuitconfig_path)
 
 
-def get_bluepy_simulation(blueconfig_path):
+def get_bluepy_circuit(circuitconfig_path):
+    return _get_bluepy_circuit(os.path.abspath(circuitconfig_path))
+
+
+@lru_cache(maxsize=8)
+def _get_bluepy_simulation(blueconfig_path):
     return Simulation(blueconfig_path)
 
 
+def get_bluepy_simulation(blueconfig_path):
+    return _get_bluepy_simulation(os.path.abspath(blueconfig_path))
+
+
 def get_bglibpy_ssim(blueconfig_path):
     try:
         import bglibpy
@@ -40,8 +55,8 @@ def ensure_dir(dirpath):
         os.makedirs(dirpath)
 
 
-def get_sim_path(root_path):
-    """Loads in simulation paths as pandas (MultiIndex) DataFrame generated by bbp-workflow"""
+@lru_cache(maxsize=8)
+def _get_sim_path(root_path):
     pklf_name = os.path.join(root_path, "analyses", "simulations.pkl")
     sim_paths = pd.read_pickle(pklf_name)
     level_names = sim_paths.index.names
@@ -50,25 +65,28 @@ def get_sim_path(root_path):
     return sim_paths
 
 
+def get_sim_path(root_path):
+    """Loads in simulation paths as pandas (MultiIndex) DataFrame generated by bbp-workflow
+    (returns a copy, so that the cached one can't be modified by the caller)"""
+    return _get_sim_path(os.path.abspath(root_path)).copy()
+
+
 def get_bluepy_circuit_from_root_path(root_path):
     """Return bluepy circuit from the first simulation in the project root"""
     return get_bluepy_simulation(get_sim_path(root_path).iloc[0]).circuit
 
 
 def get_stimulus_stream(f_name, t_start=None, t_end=None):
-    """Reads the series of presented patterns from .txt file"""
-    stim_times, patterns = [], []
-    with open(f_name, "r") as f:
-        for line in f:
-            tmp = line.strip().split()
-            stim_times.append(float(tmp[0]))
-            patterns.append(tmp[1])
-    stim_times, patterns = np.asarray(stim_times), np.asarray(patterns)
-    if t_start is None and t_end is None:  # TODO: handle them separately as well...
-        return stim_times, patterns
-    else:
-        idx = np.where((t_start < stim_times) & (stim_times < t_end))[0]
-        return stim_times[idx], patterns[idx]
+    """Reads the series of presented patterns from .txt file
+    (with pandas' C parser, and as stimulus times are sorted, selects the ones in (`t_start`, `t_end`) with binary search)"""
+    try:
+        df = pd.read_csv(f_name, sep=r"\s+", header=None, usecols=[0, 1], dtype={0: np.float64, 1: str}, engine="c")
+        stim_times, patterns = df[0].to_numpy(), df[1].to_numpy(dtype=str)
+    except pd.errors.EmptyDataError:
+        stim_times, patterns = np.array([], dtype=np.float64), np.array([], dtype=str)
+    start = 0 if t_start is None else np.searchsorted(stim_times, t_start, side="right")
+    end = len(stim_times) if t_end is None else np.searchsorted(stim_times, t_end, side="left")
+    return stim_times[start:end], patterns[start:end]
 
 
 def get_pattern_node_idx(jf_name):
@@ -85,7 +103,7 @@ def get_pattern_distance(locf_name, jf_name):
     tmp = np.loadtxt(locf_name)
     gids, pos = tmp[:, 0].astype(int), tmp[:, 1:]
     pattern_gids = get_pattern_node_idx(jf_name)
-    pattern_pos = {pattern_name: pos[np.in1d(gids, gids_, assume_unique=True), :]
+    pattern_pos = {pattern_name: pos[isin_sorted(gids, gids_), :]
                    for pattern_name, gids_ in pattern_gids.items()}
     pattern_names = np.sort(list(pattern_pos.keys()))
     row_idx, col_idx = np.triu_indices(len(pattern_names), k=1)
@@ -120,9 +138,9 @@ def _get_nrn_df(c, node_pop, target):
 
 def get_nrn_df(h5f_name, prefix, root_path, target, node_pop="S1nonbarrel_neurons"):
     """Tries to load neuron locations from saved connectivity matrix object, or calculates them if they aren't saved"""
-    h5f = h5py.File(h5f_name, "r")
-    if prefix in list(h5f.keys()):
-        h5f.close()
+    with _open_h5(h5f_name) as h5f:
+        saved = prefix in list(h5f.keys())
+    if saved:
         nrn_loc_df = load_nrn_df(h5f_name, prefix)
     else:
         nrn_loc_df = _get_nrn_df(get_bluepy_circuit_from_root_path(root_path), node_pop, target)
@@ -202,14 +220,21 @@ def group_clusters_by_patterns(clusters, t_bins, stim_times, patterns):
     isi, bin_size = np.max(np.diff(stim_times)), np.min(np.diff(t_bins))
     pattern_matrices = {pattern: np.full((np.max(counts), int(np.ceil(isi / bin_size))), np.nan)
                         for pattern in pattern_names}
-    # group sign. activity clusters based on patterns
-    row_idx = {pattern: 0 for pattern in pattern_names}
-    for pattern, t_start, t_end in zip(patterns, stim_times[:-1], stim_times[1:]):
-        idx = np.where((t_start <= t_bins) & (t_bins < t_end))[0]
-        if len(idx):
-            t_idx = ((t_bins[idx] - t_start) / bin_size).astype(int)
-            pattern_matrices[pattern][row_idx[pattern], t_idx] = clusters[idx]
-        row_idx[pattern] += 1
+    # group sign. activity clusters based on patterns: find the stimulus of all time bins with a single
+    # binary search, and the row of each stimulus (its nr. of presentations so far) from a stable sort
+    n_stims = np.minimum(len(patterns), len(stim_times) - 1)
+    stim_patterns = np.searchsorted(pattern_names, np.asarray(patterns)[:n_stims])
+    sort_idx = np.argsort(stim_patterns, kind="stable")
+    stim_rows = np.empty(n_stims, dtype=int)
+    stim_rows[sort_idx] = np.arange(n_stims) - np.searchsorted(stim_patterns[sort_idx], stim_patterns[sort_idx])
+    stim_idx = np.searchsorted(stim_times, t_bins, side="right") - 1
+    valid = (0 <= stim_idx) & (stim_idx < n_stims)
+    stim_idx, bin_clusters = stim_idx[valid], clusters[valid]
+    t_idx = ((t_bins[valid] - stim_times[stim_idx]) / bin_size).astype(int)
+    for i, pattern in enumerate(pattern_names):
+        idx = stim_patterns[stim_idx] == i
+        pattern_matrices[pattern][stim_rows[stim_idx[idx]], t_idx[idx]] = bin_clusters[idx]
+    row_idx = dict(zip(pattern_names, np.bincount(stim_patterns, minlength=len(pattern_names))))
     # find max length of sign. activity and cut all matrices there
     max_tidx = np.max([np.nonzero(~np.all(np.isnan(pattern_matrix), axis=0))[0][-1]
                        for _, pattern_matrix in pattern_matrices.items()]) + 1
@@ -218,12 +243,9 @@ def group_clusters_by_patterns(clusters, t_bins, stim_times, patterns):
     # count nr. of clusters per patterns
     pattern_counts, n_clusters = {}, len(np.unique(clusters))
     for pattern_name, matrix in pattern_matrices.items():
-        cluster_idx, cluster_counts = np.unique(matrix[~np.isnan(matrix)], return_counts=True)
-        counts = np.zeros(n_clusters, dtype=int)
-        for i in range(n_clusters):
-            if i in cluster_idx:
-                counts[i] = cluster_counts[cluster_idx == i]
-        pattern_counts[pattern_name] = counts
+        cluster_idx = matrix[~np.isnan(matrix)].astype(int)
+        cluster_idx = cluster_idx[(0 <= cluster_idx) & (cluster_idx < n_clusters)]
+        pattern_counts[pattern_name] = np.bincount(cluster_idx, minlength=n_clusters)
     return bin_size * max_tidx, row_idx, pattern_matrices, pattern_counts
 
 
@@ -235,10 +257,9 @@ def count_clusters_by_patterns_across_seeds(all_clusters, t_bins, stim_times, pa
         seeds.append(seed)
         _, _, pattern_matrices, _ = group_clusters_by_patterns(clusters, t_bins[seed], stim_times, patterns)
         for pattern, matrix in pattern_matrices.items():
-            cons_assembly_idx, counts = np.unique(matrix, return_counts=True)
-            mask = ~np.isnan(cons_assembly_idx)
-            for cons_assembly_id, count in zip(cons_assembly_idx[mask], counts[mask]):
-                count_matrices[pattern][i, int(cons_assembly_id+1)] = count
+            # consensus assembly IDs start from -1 (hence the +1), NaNs are time bins without any activity
+            cons_assembly_idx = matrix[~np.isnan(matrix)].astype(int) + 1
+            count_matrices[pattern][i, :] = np.bincount(cons_assembly_idx, minlength=n_clusters + 1)
     return count_matrices, seeds, np.array([-1] + [i for i in range(n_clusters)])
 
 
@@ -246,28 +267,67 @@ def load_pkl_df(pklf_name):
     return pd.read_pickle(pklf_name)
 
 
+def _searchsorted_isin(whom, where):
+    """Membership of `whom` in the already sorted (non-empty) `where` with binary search"""
+    idx = np.minimum(np.searchsorted(where, whom), len(where) - 1)
+    return where[idx] == whom
+
+
+def isin_sorted(whom, where):
+    """`np.in1d(whom, where)` with binary search in (sorted) `where`, instead of concatenating
+    and sorting the two arrays (`where` will be sorted if it's not sorted already, but gids usually are)"""
+    where = np.asarray(where)
+    if not len(where):
+        return np.zeros(len(whom), dtype=bool)
+    if np.any(where[1:] < where[:-1]):
+        where = np.sort(where)
+    return _searchsorted_isin(whom, where)
+
+
 def _il_isin(whom, where, parallel):
-    """Sirio's in line np.isin() using joblib as parallel backend"""
+    """Sirio's in line np.isin() using joblib as parallel backend
+    (`where` is sorted and checked for uniqueness only once, and each chunk is only binary searched)"""
+    where = np.asarray(where)
+    if not len(where):
+        return np.zeros(len(whom), dtype=bool)
+    if np.any(where[1:] < where[:-1]):
+        where = np.sort(where)
+    assert np.all(where[1:] != where[:-1]), "Node IDs to look up should be unique"
     if parallel:
         from joblib import Parallel, delayed
         nproc = os.cpu_count() - 1
         with Parallel(n_jobs=nproc, prefer="threads") as p:
-            flt = p(delayed(np.isin)(chunk, where) for chunk in np.array_split(whom, nproc))
+            flt = p(delayed(_searchsorted_isin)(chunk, where) for chunk in np.array_split(whom, nproc))
         return np.concatenate(flt)
     else:
-        return np.isin(whom, where)
+        return _searchsorted_isin(whom, where)
 
 
-def get_syn_idx(edgef_name, pre_node_idx, post_node_idx, parallel=True):
-    """Returns syn IDs between `pre_node_idx` and `post_node_idx`
-    (~1000x faster than c.connectome.pathway_synapses(pre_gids, post_gids))"""
+@lru_cache(maxsize=4)
+def _get_edge_population(edgef_name):
+    """Opens the (first) edge population of the SONATA edge file (cached, as `get_syn_idx()` below
+    is called for every assembly and reopening the file means parsing its metadata again)"""
     edges = EdgeStorage(edgef_name)
-    edge_pop = edges.open_population(list(edges.population_names)[0])
-    # sonata nodes are 0 based (and the functions expect lists of ints)
-    afferents_edges = edge_pop.afferent_edges(post_node_idx.astype(int).tolist())
-    afferent_nodes = edge_pop.source_nodes(afferents_edges)
-    flt = _il_isin(afferent_nodes, pre_node_idx.astype(int), parallel=parallel)
-    return afferents_edges.flatten()[flt]
+    return edges.open_population(list(edges.population_names)[0])
+
+
+def get_syn_idx(edgef_name, pre_node_idx, post_node_idx, parallel=True, batch_size=1024):
+    """Returns syn IDs between `pre_node_idx` and `post_node_idx`
+    (~1000x faster than c.connectome.pathway_synapses(pre_gids, post_gids))
+    Postsynaptic nodes are processed in batches of `batch_size` to cap the memory used by their afferent nodes"""
+    edge_pop = _get_edge_population(os.path.abspath(edgef_name))
+    # sorted (and deduplicated) once instead of in every `_il_isin()` call, and cast to the (uint64) dtype of
+    # sonata node IDs, so that the binary search doesn't convert the afferent nodes to a common (float) dtype
+    pre_node_idx = np.unique(np.asarray(pre_node_idx, dtype=np.uint64))
+    post_node_idx = np.asarray(post_node_idx, dtype=np.uint64)  # no copy if they are already uint64
+    syn_idx = []
+    for start in range(0, len(post_node_idx), batch_size):
+        # sonata nodes are 0 based (and the bindings take a list, which is only built for the current batch)
+        afferents_edges = edge_pop.afferent_edges(post_node_idx[start:start + batch_size].tolist())
+        afferent_nodes = edge_pop.source_nodes(afferents_edges)
+        flt = _il_isin(afferent_nodes, pre_node_idx, parallel=parallel)
+        syn_idx.append(afferents_edges.flatten()[flt])
+    return np.concatenate(syn_idx) if len(syn_idx) else np.array([], dtype=np.int64)
 
 
 def get_edge_properties(c, edge_pop, syn_idx, properties):
@@ -320,10 +380,16 @@ def save_syn_clusters(save_dir_root, assembly_idx, cluster_df, cross_assembly=Fa
     cluster_df.to_pickle(pklf_name)
 
 
+def _open_h5(h5f_name):
+    """Opens h5 file for reading with a bigger (128 MB instead of the default 1 MB) chunk cache
+    (and more hash table slots for it), so that chunks aren't read over and over again"""
+    return h5py.File(h5f_name, "r", rdcc_nbytes=128 * 1024 * 1024, rdcc_nslots=100003, rdcc_w0=0.75)
+
+
 def read_base_h5_metadata(h5f_name):
     """Reads 'base' metadata from h5 attributes (root_path, seeds etc.)"""
-    h5f = h5py.File(h5f_name, "r")
-    return dict(h5f["spikes"].attrs)
+    with _open_h5(h5f_name) as h5f:
+        return dict(h5f["spikes"].attrs)
 
 
 def _read_h5_metadata(h5f, group_name=None, prefix=None):
@@ -338,49 +404,74 @@ def _read_h5_metadata(h5f, group_name=None, prefix=None):
     return metadata
 
 
+def _read_dset(dset):
+    """Reads a whole h5py Dataset into a preallocated array with `read_direct()`
+    (bypasses h5py's high-level slicing machinery of `dset[:]`)"""
+    data = np.empty(dset.shape, dtype=dset.dtype)
+    if data.size:
+        dset.read_direct(data)
+    return data
+
+
+def _spike_matrix_from_dset(dset):
+    """Reads spike matrix from h5py Dataset. Spike matrices are always loaded as float64 (as they were originally saved),
+    so that downstream similarities/correlations have the same precision independent of how the file was written:
+    spike counts might be saved as (small) unsigned ints to save disk space (see `spikes.py/spikes_to_h5()`)"""
+    return _read_dset(dset).astype(np.float64, copy=False)
+
+
 def load_spikes_from_h5(h5f_name, prefix="spikes"):
     """Load spike matrices over seeds from saved h5 file"""
-    h5f = h5py.File(h5f_name, "r")
-    seeds = list(h5f[prefix].keys())
-    project_metadata = _read_h5_metadata(h5f, prefix=prefix)
-    prefix_grp = h5f[prefix]
-    spike_matrix_dict = {}
-    for seed in seeds:
-        spike_matrix_dict[seed] = SpikeMatrixResult(prefix_grp[seed]["spike_matrix"][:],
-                                                    prefix_grp[seed]["gids"][:],
-                                                    prefix_grp[seed]["t_bins"][:])
-    h5f.close()
+    with _open_h5(h5f_name) as h5f:
+        seeds = list(h5f[prefix].keys())
+        project_metadata = _read_h5_metadata(h5f, prefix=prefix)
+        prefix_grp = h5f[prefix]
+        spike_matrix_dict = {}
+        for seed in seeds:
+            spike_matrix_dict[seed] = SpikeMatrixResult(_spike_matrix_from_dset(prefix_grp[seed]["spike_matrix"]),
+                                                        _read_dset(prefix_grp[seed]["gids"]),
+                                                        _read_dset(prefix_grp[seed]["t_bins"]))
     return spike_matrix_dict, project_metadata
 
 
 def load_assemblies_from_h5(h5f_name, prefix="assemblies"):
     """Load assemblies over seeds from saved h5 file into dict of AssemblyGroups"""
     from assemblyfire.assemblies import AssemblyGroup
-    h5f = h5py.File(h5f_name, "r")
-    seeds = list(h5f[prefix].keys())
-    project_metadata = {seed: _read_h5_metadata(h5f, seed, prefix) for seed in seeds}
-    h5f.close()
-    assembly_grp_dict = {seed: AssemblyGroup.from_h5(h5f_name, seed, prefix=prefix) for seed in seeds}
+    # open the file only once (instead of reopening it in `AssemblyGroup.from_h5()` for every seed)
+    with _open_h5(h5f_name) as h5f:
+        seeds = list(h5f[prefix].keys())
+        project_metadata = {seed: _read_h5_metadata(h5f, seed, prefix) for seed in seeds}
+        assembly_grp_dict = {seed: AssemblyGroup.from_open_h5(h5f, seed, prefix=prefix) for seed in seeds}
     return assembly_grp_dict, project_metadata
 
 
+def iter_assemblies_from_h5(h5f_name, prefix="assemblies", seeds=None):
+    """Generator version of `load_assemblies_from_h5()` above: opens the h5 file once and yields
+    (seed, AssemblyGroup) pairs one-by-one (only for `seeds` if specified), instead of loading all of them"""
+    from assemblyfire.assemblies import AssemblyGroup
+    with _open_h5(h5f_name) as h5f:
+        seeds = list(h5f[prefix].keys()) if seeds is None else seeds
+        for seed in seeds:
+            yield seed, AssemblyGroup.from_open_h5(h5f, seed, prefix=prefix)
+
+
 def assembly_groupdic2assembly_grp(assembly_grp_dict):
     from assemblyfire.assemblies import AssemblyGroup
     """Builds 1 big assembly group from assemblies in `assembly_grp_dict` for consensus clustering"""
     gids, n_assemblies, assembly_lst = [], [], []
     for seed, assembly_grp in assembly_grp_dict.items():
-        gids.extend(assembly_grp.all.tolist())
+        gids.append(assembly_grp.all)
         n = len(assembly_grp.assemblies)
         n_assemblies.append(n)
         assembly_lst.extend([assembly_grp.assemblies[i] for i in range(n)])
-    return AssemblyGroup(assembly_lst, np.unique(gids), label="all"), n_assemblies
+    return AssemblyGroup(assembly_lst, np.unique(np.concatenate(gids)), label="all"), n_assemblies
 
 
 def load_consensus_assemblies_from_h5(h5f_name, prefix="consensus"):
     """Load consensus (clustered and thresholded )assemblies
     from saved h5 file into dict of ConsensusAssembly objects"""
     from assemblyfire.assemblies import ConsensusAssembly
-    with h5py.File(h5f_name, "r") as h5f:
+    with _open_h5(h5f_name) as h5f:
         keys = list(h5f[prefix].keys())
     return {k: ConsensusAssembly.from_h5(h5f_name, k, prefix=prefix) for k in keys}
 
@@ -389,21 +480,23 @@ def consensus_dict2assembly_grp(consensus_assemblies):
     """Create AssemblyGroup (object) from dictionary of consensus assemblies
     (AssemblyGroups are used by several functions investigating connectivity to iterate over assemblies...)"""
     from assemblyfire.assemblies import AssemblyGroup
-    cons_assembly_idx = np.sort([int(key.split("cluster")[1]) for key in list(consensus_assemblies.keys())])
+    cons_assembly_idx = np.sort(np.fromiter((key.rsplit("cluster", 1)[-1] for key in consensus_assemblies),
+                                            dtype=int, count=len(consensus_assemblies)))
     all_gids, assembly_lst = [], []
     for cons_assembly_id in cons_assembly_idx:
         cons_assembly = consensus_assemblies["cluster%i" % cons_assembly_id]
-        all_gids.extend(cons_assembly.union.gids)
+        all_gids.append(cons_assembly.union.gids)
         cons_assembly.idx = (cons_assembly_id, "consensus")
         assembly_lst.append(cons_assembly)
-    return AssemblyGroup(assemblies=assembly_lst, all_gids=np.unique(all_gids), label="ConsensusGroup")
+    return AssemblyGroup(assemblies=assembly_lst, all_gids=np.unique(np.concatenate(all_gids)),
+                         label="ConsensusGroup")
 
 
 def load_syn_nnd_from_h5(h5f_name, n_assemblies, prefix):
     """Loads synapse nearest neighbour results from h5 file
     pd.read_hdf() doesn't understand the structure, so we need to create an object, and access the DataFrame..."""
     from assemblyfire.syn_nnd import SynNNDResults
-    with h5py.File(h5f_name, "r") as h5f:
+    with _open_h5(h5f_name) as h5f:
         h5_keys = list(h5f.keys())
     assert prefix in h5_keys, "Prefix not found in HDF5 file"
     results = SynNNDResults(h5f_name, n_assemblies, prefix)
@@ -416,22 +509,20 @@ def load_syn_nnd_from_h5(h5f_name, n_assemblies, prefix):
 
 def load_single_cell_features_from_h5(h5f_name, prefix="single_cell"):
     """Load spike matrices over seeds from saved h5 file"""
-    h5f = h5py.File(h5f_name, "r")
-    prefix_grp = h5f[prefix]
-    single_cell_features = {"gids": prefix_grp["gids"][:], "r_spikes": prefix_grp["r_spikes"][:]}
-    h5f.close()
+    with _open_h5(h5f_name) as h5f:
+        prefix_grp = h5f[prefix]
+        single_cell_features = {"gids": _read_dset(prefix_grp["gids"]), "r_spikes": _read_dset(prefix_grp["r_spikes"])}
     return single_cell_features
 
 
 def read_cluster_seq_data(h5f_name):
     """Load metadata needed (stored under diff. prefixes) for re-plotting cluster (of time bin) sequences"""
-    h5f = h5py.File(h5f_name, "r")
-    spikes_metadata = _read_h5_metadata(h5f, prefix="spikes")
-    seeds = ["seed%i" % seed for seed in spikes_metadata["seeds"]]
-    assemblies_metadata = {seed: _read_h5_metadata(h5f, seed, "assemblies") for seed in seeds}
-    metadata = {"clusters": {seed: assemblies_metadata[seed]["clusters"] for seed in seeds},
-                "t_bins": {seed: h5f["spikes"][seed]["t_bins"][:] for seed in seeds},
-                "stim_times": spikes_metadata["stim_times"],
-                "patterns": spikes_metadata["patterns"]}
-    h5f.close()
+    with _open_h5(h5f_name) as h5f:
+        spikes_metadata = _read_h5_metadata(h5f, prefix="spikes")
+        seeds = ["seed%i" % seed for seed in spikes_metadata["seeds"]]
+        assemblies_metadata = {seed: _read_h5_metadata(h5f, seed, "assemblies") for seed in seeds}
+        metadata = {"clusters": {seed: assemblies_metadata[seed]["clusters"] for seed in seeds},
+                    "t_bins": {seed: _read_dset(h5f["spikes"][seed]["t_bins"]) for seed in seeds},
+                    "stim_times": spikes_metadata["stim_times"],
+                    "patterns": spikes_metadata["patterns"]}
     return metadata
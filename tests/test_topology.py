@@ -0,0 +1,124 @@
+"""
+Testing network metrics (see `assemblyfire/topology.py`) on a small, hand-checked network
+(and pinning the outputs of the helpers of the assembly membership probability/entropy analysis)
+last modified: 10.2026
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+
+from assemblyfire.assemblies import Assembly, AssemblyGroup
+import assemblyfire.topology as topology
+from assemblyfire.topology import AssemblyTopology
+
+# gids 1-6 with 8 edges: 1->2->3 and 1->3 as well as 2->3->4 and 2->4 are directed triangles,
+# 4->5->6->1 closes a (not transitive) cycle
+GIDS = np.arange(1, 7)
+EDGES = [(1, 2), (1, 3), (2, 3), (3, 4), (4, 5), (5, 6), (6, 1), (2, 4)]
+
+
+def get_conn_mat():
+    pre, post = np.array(EDGES).T - 1
+    matrix = coo_matrix((np.ones(len(EDGES), dtype=bool), (pre, post)), shape=(len(GIDS), len(GIDS)))
+    vertex_props = pd.DataFrame({"depth": np.linspace(100., 600., len(GIDS)),
+                                 "mtype": ["L23_PC", "L23_PC", "L4_SSC", "L4_SSC", "L5_TPC", "L5_TPC"]}, index=GIDS)
+    return AssemblyTopology(matrix, vertex_properties=vertex_props)
+
+
+def check_degrees(conn_mat):
+    np.testing.assert_array_equal(conn_mat.degree(kind="in"), [1, 1, 2, 2, 1, 1])
+    np.testing.assert_array_equal(conn_mat.degree(kind="out"), [2, 2, 1, 1, 1, 1])
+    # within [1, 2, 3, 4] (in the order of the passed gids)
+    np.testing.assert_array_equal(conn_mat.degree([1, 2, 3, 4], kind="in"), [0, 1, 2, 2])
+    np.testing.assert_array_equal(conn_mat.degree([4, 2, 1, 3], kind="in"), [2, 1, 0, 2])
+    np.testing.assert_array_equal(conn_mat.degree([1, 2, 3, 4], kind="out"), [2, 2, 1, 0])
+    # from [1, 2] to [3, 4]
+    np.testing.assert_array_equal(conn_mat.degree([1, 2], [3, 4], kind="in"), [2, 1])
+    np.testing.assert_array_equal(conn_mat.degree([1, 2], [3, 4], kind="out"), [1, 2])
+
+
+def check_group_degrees(conn_mat):
+    group_gids = [np.array([1, 2]), np.array([3, 4, 5])]
+    np.testing.assert_array_equal(conn_mat.group_degrees(group_gids, [3, 4, 6], kind="in"), [[2, 0], [1, 1], [0, 1]])
+    np.testing.assert_array_equal(conn_mat.group_degrees(group_gids, [3, 4, 6], kind="out"), [[0, 1], [0, 1], [1, 0]])
+
+
+def check_density(conn_mat):
+    assert np.isclose(conn_mat.density(), 8 / 36)
+    assert np.isclose(conn_mat.density([1, 2, 3, 4]), 5 / 16)
+    assert np.isclose(conn_mat.density([4, 5]), 1 / 4)
+
+
+def check_simplex_counts(conn_mat):
+    assert conn_mat.simplex_counts_groups([]) == []
+    simplex_counts = conn_mat.simplex_counts_groups([np.array([1, 2, 3, 4])])
+    assert len(simplex_counts) == 1
+    np.testing.assert_array_equal(simplex_counts[0], [4, 5, 2])
+    simplex_counts = conn_mat.simplex_counts_groups([np.array([1, 2, 3, 4]), np.array([4, 5, 6]), np.array([1, 2])])
+    for simplex_count, expected in zip(simplex_counts, [[4, 5, 2], [3, 2], [2, 1]]):
+        np.testing.assert_array_equal(simplex_count, expected)
+    # seed without assemblies
+    assembly_grp = AssemblyGroup([], GIDS, label="seed1")
+    simplex_counts, s_c_control = topology.simplex_counts_assemblies({"seed1": assembly_grp}, conn_mat)
+    assert simplex_counts == {"seed1": {}}
+    assert s_c_control == {"seed1": {"n": {}, "depths": {}, "mtypes": {}}}
+    assert topology.simplex_counts_consensus_instantiations(assembly_grp, conn_mat) == ({}, {})
+
+
+def check_chance_levels():
+    chance_levels = topology._chance_levels(GIDS, [np.array([1, 2, 3]), np.array([5, 9]), np.array([], dtype=int)])
+    np.testing.assert_allclose(chance_levels, [3 / 6, 1 / 6, 0.])
+    assert len(topology._chance_levels(GIDS, [])) == 0
+
+
+def check_bin_gids_by_innervation():
+    innervation = {"indegree": [0, 1, 2, 3, 4], "zscored": [-2., -1., 0., 1., 2.]}
+    bin_centers, bin_idx = topology.bin_gids_by_innervation(innervation, np.arange(5), 2)
+    # 0 indegrees are ignored (first bin edge is 0), the rest is binned between the 1st and 99th percentiles
+    np.testing.assert_allclose(bin_centers["indegree"], [0.515, 2.5])
+    np.testing.assert_array_equal(bin_idx["indegree"], [0, 1, 2, 2, 3])
+    np.testing.assert_allclose(bin_centers["zscored"], [-0.98, 0.98])
+    np.testing.assert_array_equal(bin_idx["zscored"], [0, 1, 1, 2, 3])
+
+
+def check_entropy_helpers():
+    # membership fully determined by the bins: MI = H
+    h, mi = topology._binned_entropy_mi(np.array([1, 1, 0, 0], dtype=bool), np.array([0, 2, 2]), np.array([0, 2, 0]))
+    assert np.isclose(h, 1.) and np.isclose(mi, 1.)
+    # membership independent of the bins: MI = 0
+    h, mi = topology._binned_entropy_mi(np.array([1, 0, 1, 0], dtype=bool), np.array([0, 2, 2]), np.array([0, 1, 1]))
+    assert np.isclose(h, 1.) and np.isclose(mi, 0.)
+    assert topology._sign(np.array([1., 2., 3.]), np.array([0.1, 0.2, 0.3])) == 1
+    assert topology._sign(np.array([1., 2., 3.]), np.array([0.3, 0.2, 0.1])) == -1
+    # a single (heavy) bin can flip the sign of the weighted fit
+    assert topology._sign(np.array([1., 2., 3.]), np.array([0.1, 0.3, 0.2]), np.array([1, 100, 1])) == 1
+    assert topology._sign(np.array([1., 2., 3.]), np.array([0.3, 0.1, 0.2]), np.array([100, 1, 1])) == -1
+
+
+def check_rel_frac_entropy_explained():
+    gids = np.arange(1, 9)
+    assembly_grp = AssemblyGroup([Assembly(np.array([1, 2, 3, 4]), index=(0, 1)),
+                                  Assembly(np.array([5, 6]), index=(1, 1))], gids, label="seed1")
+    bin_centers = {"indegree": np.array([1., 2.])}
+    bin_idx = {"indegree": np.array([1, 1, 1, 1, 2, 2, 2, 2])}
+    mi_matrix, keys, assembly_idx = topology.assembly_rel_frac_entropy_explained(
+        gids, assembly_grp, bin_centers, bin_idx, "seed1", 1, 0, rng=np.random.default_rng(12345))
+    np.testing.assert_array_equal(keys, ["indegree"])
+    np.testing.assert_array_equal(assembly_idx, [0, 1])
+    # assembly 0 is all gids in the low bin (MI = H, negative slope),
+    # assembly 1 is half of the high bin (MI = 1 - 0.5 / H(0.25), positive slope)
+    np.testing.assert_allclose(mi_matrix, [[-1., 1 - 0.5 / topology._binary_entropy(0.25)]], rtol=1e-6)
+
+
+if __name__ == "__main__":
+    conn_mat = get_conn_mat()
+    check_degrees(conn_mat)
+    check_group_degrees(conn_mat)
+    check_density(conn_mat)
+    check_simplex_counts(conn_mat)
+    check_chance_levels()
+    check_bin_gids_by_innervation()
+    check_entropy_helpers()
+    check_rel_frac_entropy_explained()
+    print("All topology checks passed")
@@ -0,0 +1,130 @@
+"""
+Testing (I/O and binning) utility functions on small, hand-checked inputs (written to a temporary directory)
+last modified: 10.2026
+"""
+
+import os
+import tempfile
+import h5py
+import numpy as np
+
+from assemblyfire.utils import (get_stimulus_stream, group_clusters_by_patterns, count_clusters_by_patterns_across_seeds,
+                                get_syn_idx, load_spikes_from_h5)
+from assemblyfire.spikes import SpikeMatrixResult, spikes_to_h5
+
+# (source, target) node IDs of the edges (0 based and sorted by target, as in SONATA edge files)
+EDGES = [(0, 1), (2, 1), (0, 2), (1, 2), (3, 2), (2, 3)]
+
+
+def check_stimulus_stream(tmp_dir):
+    f_name = os.path.join(tmp_dir, "stim_stream.txt")
+    with open(f_name, "w") as f:
+        f.write("0.0 A\n200.0 B\n400.0 A\n600.5 C\n")
+    stim_times, patterns = get_stimulus_stream(f_name)
+    np.testing.assert_array_equal(stim_times, [0., 200., 400., 600.5])
+    np.testing.assert_array_equal(patterns, ["A", "B", "A", "C"])
+    # bounds are exclusive and can be given separately
+    stim_times, patterns = get_stimulus_stream(f_name, 0., 600.5)
+    np.testing.assert_array_equal(stim_times, [200., 400.])
+    np.testing.assert_array_equal(patterns, ["B", "A"])
+    stim_times, patterns = get_stimulus_stream(f_name, t_start=200.)
+    np.testing.assert_array_equal(patterns, ["A", "C"])
+    stim_times, patterns = get_stimulus_stream(f_name, t_end=200.)
+    np.testing.assert_array_equal(patterns, ["A"])
+    f_name = os.path.join(tmp_dir, "empty_stim_stream.txt")
+    open(f_name, "w").close()
+    stim_times, patterns = get_stimulus_stream(f_name)
+    assert len(stim_times) == 0 and stim_times.dtype == np.float64 and len(patterns) == 0
+
+
+def check_group_clusters_by_patterns():
+    # 3 stimuli: A in [0, 100), B in [100, 200) and A in [200, 300) (the last pattern isn't followed by a stim. time)
+    stim_times = np.array([0., 100., 200., 300.])
+    patterns = np.array(["A", "B", "A", "B"])
+    t_bins = np.array([0., 20., 40., 100., 120., 200., 220., 240.])
+    clusters = np.array([0, 1, 0, 1, 2, 0, 0, 1])
+    max_t, row_idx, pattern_matrices, pattern_counts = group_clusters_by_patterns(clusters, t_bins,
+                                                                                  stim_times, patterns)
+    assert max_t == 60.
+    assert row_idx == {"A": 2, "B": 1}
+    np.testing.assert_array_equal(pattern_matrices["A"], [[0, 1, 0], [0, 0, 1]])
+    np.testing.assert_array_equal(pattern_matrices["B"], [[1, 2, np.nan], [np.nan, np.nan, np.nan]])
+    np.testing.assert_array_equal(pattern_counts["A"], [4, 2, 0])
+    np.testing.assert_array_equal(pattern_counts["B"], [0, 1, 1])
+    # same with consensus assembly IDs (starting from -1) across 2 seeds
+    count_matrices, seeds, cons_assembly_idx = count_clusters_by_patterns_across_seeds(
+        {"seed1": clusters - 1, "seed2": clusters}, {"seed1": t_bins, "seed2": t_bins}, stim_times, patterns, 3)
+    assert seeds == ["seed1", "seed2"]
+    np.testing.assert_array_equal(cons_assembly_idx, [-1, 0, 1, 2])
+    np.testing.assert_array_equal(count_matrices["A"], [[4, 2, 0, 0], [0, 4, 2, 0]])
+    np.testing.assert_array_equal(count_matrices["B"], [[0, 1, 1, 0], [0, 0, 1, 1]])
+
+
+def _write_sonata_edges(edgef_name, edges, n_nodes, population="default"):
+    """Writes minimal SONATA edge file (with the indices needed for `afferent_edges()`)"""
+    src, tgt = np.array(edges, dtype=np.uint64).T
+
+    def _write_index(grp, node_ids):
+        node_id_to_ranges, range_to_edge_id = np.zeros((n_nodes, 2), dtype=np.uint64), []
+        for node_id in range(n_nodes):
+            edge_ids = np.nonzero(node_ids == node_id)[0]
+            if len(edge_ids):
+                # consecutive edge IDs make one range
+                splits = np.split(edge_ids, np.nonzero(np.diff(edge_ids) > 1)[0] + 1)
+                node_id_to_ranges[node_id] = [len(range_to_edge_id), len(range_to_edge_id) + len(splits)]
+                range_to_edge_id.extend([[split[0], split[-1] + 1] for split in splits])
+        grp.create_dataset("node_id_to_ranges", data=node_id_to_ranges)
+        grp.create_dataset("range_to_edge_id", data=np.array(range_to_edge_id, dtype=np.uint64))
+
+    with h5py.File(edgef_name, "w") as h5f:
+        grp = h5f.create_group("edges/%s" % population)
+        for name, node_ids in zip(["source_node_id", "target_node_id"], [src, tgt]):
+            grp.create_dataset(name, data=node_ids)
+            grp[name].attrs["node_population"] = "nodes"
+        grp.create_dataset("edge_type_id", data=np.full(len(edges), -1, dtype=np.int64))
+        grp.create_dataset("edge_group_id", data=np.zeros(len(edges), dtype=np.uint32))
+        grp.create_dataset("edge_group_index", data=np.arange(len(edges), dtype=np.uint64))
+        grp.create_group("0").create_dataset("syn_weight", data=np.ones(len(edges), dtype=np.float32))
+        _write_index(grp.create_group("indices/source_to_target"), src)
+        _write_index(grp.create_group("indices/target_to_source"), tgt)
+
+
+def check_syn_idx(tmp_dir):
+    edgef_name = os.path.join(tmp_dir, "edges.h5")
+    _write_sonata_edges(edgef_name, EDGES, 4)
+    # edges 0, 1 (from 0 and 2 to 1) and 2 (from 0 to 2), but not 3 and 4 (from 1 and 3 to 2)
+    for parallel in [False, True]:
+        for batch_size in [1, 1024]:
+            syn_idx = get_syn_idx(edgef_name, np.array([2, 0, 2]), np.array([1, 2]), parallel, batch_size)
+            np.testing.assert_array_equal(np.sort(syn_idx), [0, 1, 2])
+    assert len(get_syn_idx(edgef_name, np.array([1]), np.array([1, 3]))) == 0
+
+
+def check_spike_matrix_dtypes(tmp_dir):
+    h5f_name = os.path.join(tmp_dir, "spikes.h5")
+    spike_matrices = {1: np.array([[0., 2., 300.], [1., 0., 0.]]),  # spike counts (saved as uint16)
+                      2: np.array([[0., -1.], [1., 0.]]),  # integral but negative (saved as it is)
+                      3: np.array([[0.5, 1.], [0.25, 0.]])}  # averaged spike counts
+    spike_matrix_dict = {seed: SpikeMatrixResult(spike_matrix, np.array([10, 20]),
+                                                 np.arange(spike_matrix.shape[1], dtype=np.float64))
+                         for seed, spike_matrix in spike_matrices.items()}
+    spikes_to_h5(h5f_name, spike_matrix_dict, {"seeds": list(spike_matrices.keys())}, "spikes")
+    with h5py.File(h5f_name, "r") as h5f:
+        assert h5f["spikes/seed1/spike_matrix"].dtype == np.uint16
+        assert h5f["spikes/seed2/spike_matrix"].dtype == np.float64
+    loaded_dict, _ = load_spikes_from_h5(h5f_name, "spikes")
+    for seed, spike_matrix in spike_matrices.items():
+        loaded = loaded_dict["seed%i" % seed]
+        assert loaded.spike_matrix.dtype == np.float64
+        np.testing.assert_array_equal(loaded.spike_matrix, spike_matrix)
+        np.testing.assert_array_equal(loaded.gids, [10, 20])
+        np.testing.assert_array_equal(loaded.t_bins, spike_matrix_dict[seed].t_bins)
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        check_stimulus_stream(tmp_dir)
+        check_group_clusters_by_patterns()
+        check_syn_idx(tmp_dir)
+        check_spike_matrix_dtypes(tmp_dir)
+    print("All utils checks passed")